@@ -6,11 +6,11 @@ screen: PaPiRus ePaper / eInk Screen HAT for Raspberry Pi - 2.7"
 output: copy of the screen in file: image.bmp
 """
 
-import json
 import time
 import os
 import sys
 import logging
+import utils
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
@@ -37,15 +37,6 @@ g_image = None
 def timestr(t):
     return time.strftime('%H:%M',time.localtime(t))
 
-def read_json(filename):
-    """Read a JSON file to a dict object."""
-    with open(filename, 'r') as f:
-        try:
-            data = json.load(f)
-        except json.decoder.JSONDecodeError:
-            data = dict()
-    return data
-
 def trend_symbol(trend):
     """Unicode symbol for temperature trend"""
     if trend == 'up':
@@ -83,7 +74,7 @@ def draw_image():
 
     # read data
     if os.path.isfile(data_filename):
-        g_data = read_json(data_filename)
+        g_data = utils.load_json(data_filename)
     else:
         logging.error("No data file")
         return
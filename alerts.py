@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""alerts.py
+Threshold alerts on the station data, the forecast and the derived metrics.
+Rules are compiled once from the "alerts" section of config/config.json:
+  "alerts": {
+    "webhook_url": "http://localhost:8765/",
+    "rules": [
+      {"name": "co2", "field": "indoor.CO2", "above": 1200, "clear": 1000},
+      {"name": "frost", "field": "forecast.min_temperature_12h", "below": 0, "clear": 1},
+      {"name": "station_unreachable", "field": "station.age_seconds", "above": 1800},
+      {"name": "outdoor_lost", "field": "outdoor.reachable", "equals": false}
+    ]
+  }
+Each update flattens the data files into facts ("outdoor.Temperature",
+"derived.dew_point", "forecast.min_temperature_12h", "station.age_seconds",
+...). Only the rules whose field changed are evaluated. A rule notifies
+when it starts firing and when it clears; "clear" gives hysteresis and
+"repeat_seconds" re-sends while it keeps firing. Notifications are posted
+in batches by a background sender that retries with backoff.
+
+usage: python3 alerts.py receiver [port] [failures]
+  local webhook stand-in that prints the batches it receives and answers
+  the first `failures` requests with 503 to exercise the retries.
+"""
+
+import http.server
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+import runtime
+import utils
+
+alertsLogger = logging.getLogger(__name__)
+
+alerts_state_filename = "data/alerts_state.json"
+EVALUATE_INTERVAL_SECONDS = 60
+FORECAST_HOURS = (6, 12, 24)
+# Netatmo module type -> fact prefix
+MODULE_NAMES = {
+    "NAMain": "indoor",
+    "NAModule1": "outdoor",
+    "NAModule2": "wind",
+    "NAModule3": "rain",
+    "NAModule4": "indoor2",
+}
+# module fields besides dashboard_data
+MODULE_FIELDS = ("reachable", "battery_percent", "rf_status", "wifi_status")
+# webhook sender
+BATCH_SECONDS = 5
+MAX_BATCH = 50
+MAX_QUEUE = 1000
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 2
+REQUEST_TIMEOUT = (5, 10)
+DEFAULT_RECEIVER_PORT = 8765
+
+
+class Rule:
+    """One compiled rule. Raises ValueError for an incomplete spec."""
+
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.field = spec["field"]
+        self.message = spec.get("message")
+        self.repeat_seconds = spec.get("repeat_seconds")
+        if "above" in spec:
+            self.op, self.threshold = "above", spec["above"]
+            clear = spec.get("clear", self.threshold)
+            self.fires = lambda value: value > self.threshold
+            self.clears = lambda value: value <= clear
+        elif "below" in spec:
+            self.op, self.threshold = "below", spec["below"]
+            clear = spec.get("clear", self.threshold)
+            self.fires = lambda value: value < self.threshold
+            self.clears = lambda value: value >= clear
+        elif "equals" in spec:
+            self.op, self.threshold = "equals", spec["equals"]
+            self.fires = lambda value: value == self.threshold
+            self.clears = lambda value: value != self.threshold
+        else:
+            raise ValueError("rule %s needs above, below or equals" % self.name)
+
+    def notification(self, state, value, now):
+        message = self.message or "%s %s %s" % (self.field, self.op, self.threshold)
+        return {
+            "rule": self.name,
+            "state": state,
+            "field": self.field,
+            "value": value,
+            "threshold": self.threshold,
+            "message": message,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+        }
+
+
+class AlertEngine:
+    def __init__(self, rules, firing=None):
+        self.rules = rules
+        self.by_field = dict()
+        for rule in rules:
+            self.by_field.setdefault(rule.field, []).append(rule)
+        self.facts = dict()
+        # rule name -> time of the last notification while firing
+        self.firing = dict((name, t) for name, t in (firing or {}).items()
+                           if name in set(rule.name for rule in rules))
+        self.evaluations = 0
+
+    def evaluate(self, facts, now):
+        """Evaluates the rules whose field changed since the last call. Returns the notifications."""
+        changed = [field for field in self.by_field if facts.get(field) != self.facts.get(field)]
+        self.facts = facts
+        notifications = []
+        for field in changed:
+            value = facts.get(field)
+            if value is None:
+                continue
+            for rule in self.by_field[field]:
+                self.evaluations += 1
+                try:
+                    if rule.name not in self.firing and rule.fires(value):
+                        self.firing[rule.name] = now
+                        notifications.append(rule.notification("firing", value, now))
+                    elif rule.name in self.firing and rule.clears(value):
+                        del self.firing[rule.name]
+                        notifications.append(rule.notification("resolved", value, now))
+                except TypeError:
+                    alertsLogger.warning("Rule %s cannot compare %r", rule.name, value)
+        for rule in self.rules:
+            if rule.repeat_seconds and rule.name in self.firing and now - self.firing[rule.name] >= rule.repeat_seconds:
+                self.firing[rule.name] = now
+                notifications.append(rule.notification("firing", facts.get(rule.field), now))
+        return notifications
+
+
+class WebhookSender:
+    """Posts notifications to url in batches from a background thread.
+    Failed batches are retried with exponential backoff, then dropped."""
+
+    def __init__(self, url):
+        self.url = url
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stats = {"queued": 0, "sent": 0, "batches": 0, "retries": 0, "failed": 0, "dropped": 0}
+        self.thread = threading.Thread(target=self.run, name="alerts-webhook", daemon=True)
+        self.thread.start()
+
+    def send(self, notification):
+        with self.condition:
+            if len(self.queue) >= MAX_QUEUE:
+                self.queue.popleft()
+                self.stats["dropped"] += 1
+            self.queue.append(notification)
+            self.stats["queued"] += 1
+            self.condition.notify()
+
+    def next_batch(self):
+        """Waits for a notification, then up to BATCH_SECONDS for more to join its batch."""
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            deadline = time.monotonic() + BATCH_SECONDS
+            while len(self.queue) < MAX_BATCH and time.monotonic() < deadline:
+                self.condition.wait(timeout=deadline - time.monotonic())
+            return [self.queue.popleft() for i in range(min(MAX_BATCH, len(self.queue)))]
+
+    def deliver(self, batch):
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = runtime.http_post(self.url, json={"alerts": batch}, timeout=REQUEST_TIMEOUT)
+                if response.status_code < 400:
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    alertsLogger.error("Webhook rejected %d alerts: %d", len(batch), response.status_code)
+                    return False
+                alertsLogger.warning("Webhook answered %d", response.status_code)
+            except Exception:
+                alertsLogger.warning("Webhook request failed", exc_info=1)
+            if attempt + 1 < MAX_ATTEMPTS:
+                with self.condition:
+                    self.stats["retries"] += 1
+                time.sleep(RETRY_SECONDS * 2 ** attempt)
+        return False
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            ok = self.deliver(batch)
+            with self.condition:
+                self.stats["batches"] += 1
+                self.stats["sent" if ok else "failed"] += len(batch)
+            alertsLogger.info("Webhook batch of %d alerts %s", len(batch), "sent" if ok else "failed")
+
+    def sender_stats(self):
+        with self.condition:
+            return dict(self.stats, pending=len(self.queue))
+
+
+# Global variables
+g_engine = None
+g_sender = None
+
+def station_facts(station_data, now):
+    facts = dict()
+    devices = station_data.get("body", {}).get("devices", [])
+    if not devices:
+        return facts
+    device = devices[0]
+    seen = set()
+    for module in [device] + list(device.get("modules", [])):
+        prefix = MODULE_NAMES.get(module.get("type"))
+        # only the first module of each type
+        if prefix is None or prefix in seen:
+            continue
+        seen.add(prefix)
+        for key, value in module.get("dashboard_data", {}).items():
+            facts[prefix + "." + key] = value
+        for key in MODULE_FIELDS:
+            if key in module:
+                facts[prefix + "." + key] = module[key]
+    if "time_utc" in device.get("dashboard_data", {}):
+        facts["station.age_seconds"] = int(now - device["dashboard_data"]["time_utc"])
+    facts["station.reachable"] = device.get("reachable")
+    return facts
+
+def forecast_facts(weather_data, now):
+    """Minimum temperature, maximum wind and total precipitation over the next hours."""
+    facts = dict()
+    upcoming = []
+    for entry in weather_data.get("properties", {}).get("timeseries", []):
+        t = utils.parse_utc(entry["time"])
+        if t >= now - 3600:
+            upcoming.append((t, entry["data"]))
+    for hours in FORECAST_HOURS:
+        window = [data for t, data in upcoming if t < now + hours * 3600]
+        temperatures = [data["instant"]["details"]["air_temperature"] for data in window
+                        if "air_temperature" in data.get("instant", {}).get("details", {})]
+        winds = [data["instant"]["details"]["wind_speed"] for data in window
+                 if "wind_speed" in data.get("instant", {}).get("details", {})]
+        precipitation = [data["next_1_hours"]["details"].get("precipitation_amount", 0) for data in window
+                         if "next_1_hours" in data]
+        if temperatures:
+            facts["forecast.min_temperature_%dh" % hours] = min(temperatures)
+        if winds:
+            facts["forecast.max_wind_speed_%dh" % hours] = max(winds)
+        if precipitation:
+            facts["forecast.precipitation_%dh" % hours] = round(sum(precipitation), 1)
+    return facts
+
+def collect_facts(now):
+    """Flat field -> value view of the data files the rules can refer to."""
+    import derived
+    import netatmo
+    import weather
+    facts = dict()
+    if os.path.isfile(netatmo.data_filename):
+        facts.update(station_facts(utils.load_json(netatmo.data_filename), now))
+    if os.path.isfile(weather.weather_data_filename):
+        facts.update(forecast_facts(utils.load_json(weather.weather_data_filename), now))
+    if os.path.isfile(derived.derived_filename):
+        for key, value in utils.load_json(derived.derived_filename).items():
+            facts["derived." + key] = value
+    return facts
+
+def compile_rules(specs):
+    rules = []
+    for spec in specs:
+        try:
+            rules.append(Rule(spec))
+        except (KeyError, ValueError) as e:
+            alertsLogger.error("Ignoring alert rule %r: %r", spec, e)
+    return rules
+
+def update(config):
+    """One evaluation. Rules and the sender are set up on the first call."""
+    global g_engine, g_sender
+    alerts_config = config.get("alerts", {})
+    if g_engine is None:
+        firing = dict()
+        if os.path.isfile(alerts_state_filename):
+            firing = utils.read_json(alerts_state_filename).get("firing", {})
+        g_engine = AlertEngine(compile_rules(alerts_config.get("rules", [])), firing)
+        if alerts_config.get("webhook_url"):
+            g_sender = WebhookSender(alerts_config["webhook_url"])
+        alertsLogger.info("%d alert rules on %d fields", len(g_engine.rules), len(g_engine.by_field))
+    now = runtime.now()
+    notifications = g_engine.evaluate(collect_facts(now), now)
+    for notification in notifications:
+        alertsLogger.warning("Alert %s %s: %s (%s)", notification["rule"], notification["state"],
+                             notification["message"], notification["value"])
+        if g_sender is not None:
+            g_sender.send(notification)
+    if notifications:
+        utils.write_json({"firing": g_engine.firing}, alerts_state_filename)
+    return True
+
+def alerts_stats():
+    if g_engine is None:
+        return None
+    return {
+        "rules": len(g_engine.rules),
+        "firing": sorted(g_engine.firing),
+        "evaluations": g_engine.evaluations,
+        "webhook": g_sender.sender_stats() if g_sender is not None else None,
+    }
+
+
+class ReceiverHandler(http.server.BaseHTTPRequestHandler):
+    """Webhook stand-in: prints each batch, fails the first `failures` requests."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        print(json.dumps(json.loads(body), indent=2), flush=True)
+        self.send_response(204)
+        self.end_headers()
+
+def receiver(port=DEFAULT_RECEIVER_PORT, failures=0):
+    httpd = http.server.HTTPServer(("", port), ReceiverHandler)
+    httpd.failures = failures
+    alertsLogger.warning("Webhook stand-in listening on http://localhost:%d/", port)
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    if len(sys.argv) < 2 or sys.argv[1] != "receiver":
+        print(__doc__)
+        sys.exit(1)
+    receiver(*[int(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""bench_startup.py
+Measures the cold start of server.py: time until /healthz answers and
+until the services are loaded ("services": "ready").
+Every run starts server.py in a scratch directory with a dummy config,
+so the numbers do not depend on local data or credentials.
+usage: python3 bench_startup.py [runs]
+"""
+
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RUNS = 5
+TIMEOUT_SECONDS = 60
+POLL_SECONDS = 0.01
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def healthz(port):
+    """The /healthz payload, or None while the server is not answering."""
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d/healthz" % port, timeout=1) as response:
+            return json.loads(response.read())
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+def run_once():
+    """Seconds from process start to the first /healthz answer and to services ready."""
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        os.makedirs(os.path.join(workdir, "config"))
+        with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+            json.dump({"client_id": "xxxx", "client_secret": "xxxx", "device_id": "xxxx", "port": port}, f)
+        with open(os.path.join(workdir, "config", "token.json"), "w") as f:
+            json.dump({"access_token": "xxxx", "refresh_token": "xxxx"}, f)
+
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py")], cwd=workdir,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        first_answer = None
+        try:
+            while time.perf_counter() - started < TIMEOUT_SECONDS:
+                payload = healthz(port)
+                if payload is not None:
+                    if first_answer is None:
+                        first_answer = time.perf_counter() - started
+                    if payload.get("services") == "ready":
+                        return first_answer, time.perf_counter() - started
+                if process.poll() is not None:
+                    raise RuntimeError("server.py exited with status %d" % process.returncode)
+                time.sleep(POLL_SECONDS)
+            raise RuntimeError("server.py did not become ready in %d s" % TIMEOUT_SECONDS)
+        finally:
+            process.terminate()
+            process.wait()
+
+def import_time():
+    """Seconds to import server.py in a fresh interpreter."""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import server"], cwd=HERE, check=True)
+    return time.perf_counter() - started
+
+def summary(values):
+    return {
+        "min": round(min(values), 3),
+        "median": round(statistics.median(values), 3),
+        "max": round(max(values), 3),
+    }
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    imports, healthz_times, ready_times = [], [], []
+    for run in range(runs):
+        imports.append(import_time())
+        first_answer, ready = run_once()
+        healthz_times.append(first_answer)
+        ready_times.append(ready)
+        print("run %d: import %.3f s, /healthz %.3f s, services ready %.3f s"
+              % (run + 1, imports[-1], first_answer, ready), file=sys.stderr)
+    print(json.dumps({
+        "runs": runs,
+        "python": sys.version.split()[0],
+        "import_server_seconds": summary(imports),
+        "healthz_seconds": summary(healthz_times),
+        "services_ready_seconds": summary(ready_times),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""derived.py
+Derived weather metrics, computed once per new Netatmo observation:
+dew point, feels-like temperature (wind chill or humidex), rain rate and
+1 h/3 h pressure and temperature tendencies.
+Tendencies come from sliding windows trimmed as samples arrive, so an
+update costs O(1) amortized and history is never rescanned.
+output: data/derived.json (the window state is kept in data/derived_state.json)
+"""
+
+import logging
+import math
+import os
+from collections import deque
+import utils
+
+derivedLogger = logging.getLogger(__name__)
+
+derived_filename = "data/derived.json"
+derived_state_filename = "data/derived_state.json"
+TENDENCY_HOURS = (1, 3)
+# a tendency needs samples covering this share of its window,
+# and is dropped when the reference sample is older than twice the window
+MIN_COVERAGE = 0.75
+MAX_SPAN = 2
+# Netatmo reports Rain for the last 5 minute measurement
+RAIN_MEASUREMENT_SECONDS = 300
+# wind chill below this temperature (with some wind), humidex above the other
+WIND_CHILL_MAX_TEMPERATURE = 10.0
+WIND_CHILL_MIN_WIND = 4.8
+HUMIDEX_MIN_TEMPERATURE = 20.0
+
+
+class Tendency:
+    """Change of a value over the last `seconds`.
+    The window keeps one sample at or before now - seconds as the reference."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()
+
+    def add(self, t, value):
+        self.samples.append((t, value))
+        while len(self.samples) > 1 and self.samples[1][0] <= t - self.seconds:
+            self.samples.popleft()
+
+    def value(self):
+        """Change over the window (scaled to exactly `seconds`), None without enough history."""
+        if len(self.samples) < 2:
+            return None
+        (t0, v0), (t1, v1) = self.samples[0], self.samples[-1]
+        span = t1 - t0
+        if span < self.seconds * MIN_COVERAGE or span > self.seconds * MAX_SPAN:
+            return None
+        return round((v1 - v0) * self.seconds / span, 2)
+
+
+# Global variables
+# time_utc of the last observation, None until the state is loaded
+g_last_time = None
+# "pressure_tendency_1h", "temperature_tendency_3h", ... -> Tendency
+g_tendencies = None
+
+def dew_point(temperature, humidity):
+    """Magnus formula, degrees C."""
+    gamma = math.log(humidity / 100.0) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+def humidex(temperature, dew_point):
+    vapour_pressure = 6.11 * math.exp(5417.7530 * (1 / 273.16 - 1 / (273.15 + dew_point)))
+    return temperature + 0.5555 * (vapour_pressure - 10.0)
+
+def wind_chill(temperature, wind):
+    """Canadian/US wind chill index, wind in km/h."""
+    wind = wind ** 0.16
+    return 13.12 + 0.6215 * temperature - 11.37 * wind + 0.3965 * temperature * wind
+
+def load_state():
+    """Restores the tendency windows, once per process."""
+    global g_last_time, g_tendencies
+    if g_tendencies is not None:
+        return
+    g_tendencies = dict()
+    for name in ("pressure", "temperature"):
+        for hours in TENDENCY_HOURS:
+            g_tendencies["%s_tendency_%dh" % (name, hours)] = Tendency(hours * 3600)
+    if os.path.isfile(derived_state_filename):
+        state = utils.read_json(derived_state_filename)
+        g_last_time = state.get("time_utc")
+        for key, samples in state.get("windows", {}).items():
+            if key in g_tendencies:
+                for t, value in samples:
+                    g_tendencies[key].add(t, value)
+
+def save_state():
+    windows = dict((key, list(tendency.samples)) for key, tendency in g_tendencies.items())
+    utils.write_json({"time_utc": g_last_time, "windows": windows}, derived_state_filename)
+
+def update(station_data):
+    """Adds the observation in a getstationsdata result and writes derived.json.
+    Returns the derived metrics, or None when the observation was seen before."""
+    global g_last_time
+    devices = station_data.get("body", {}).get("devices", [])
+    if not devices or "dashboard_data" not in devices[0]:
+        return None
+    device = devices[0]
+    t = device["dashboard_data"].get("time_utc")
+    load_state()
+    if t is None or (g_last_time is not None and t <= g_last_time):
+        return None
+    g_last_time = t
+
+    # a missing or unreachable module (no dashboard_data) leaves its metrics out
+    modules = dict((module.get("type"), module.get("dashboard_data", {})) for module in device.get("modules", []))
+    outdoor = modules.get("NAModule1", {})
+    temperature = outdoor.get("Temperature")
+    humidity = outdoor.get("Humidity")
+    wind = modules.get("NAModule2", {}).get("WindStrength")
+    rain = modules.get("NAModule3", {}).get("Rain")
+    pressure = device["dashboard_data"].get("Pressure")
+
+    derived = {"time_utc": t}
+    if pressure is not None:
+        derived["pressure"] = pressure
+        for hours in TENDENCY_HOURS:
+            g_tendencies["pressure_tendency_%dh" % hours].add(t, pressure)
+    if temperature is not None:
+        for hours in TENDENCY_HOURS:
+            g_tendencies["temperature_tendency_%dh" % hours].add(t, temperature)
+        feels_like, kind = temperature, "air"
+        if humidity:
+            dew = dew_point(temperature, humidity)
+            derived["dew_point"] = round(dew, 1)
+            if temperature >= HUMIDEX_MIN_TEMPERATURE:
+                feels_like, kind = humidex(temperature, dew), "humidex"
+        if wind is not None and temperature <= WIND_CHILL_MAX_TEMPERATURE and wind > WIND_CHILL_MIN_WIND:
+            feels_like, kind = wind_chill(temperature, wind), "wind_chill"
+        derived["feels_like"] = round(feels_like, 1)
+        derived["feels_like_kind"] = kind
+    if rain is not None:
+        # mm/h
+        derived["rain_rate"] = round(rain * 3600 / RAIN_MEASUREMENT_SECONDS, 2)
+    for key, tendency in g_tendencies.items():
+        derived[key] = tendency.value()
+
+    utils.write_json(derived, derived_filename)
+    save_state()
+    derivedLogger.debug("update() %s", derived)
+    return derived
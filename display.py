@@ -6,7 +6,6 @@ screen: PaPiRus ePaper / eInk Screen HAT for Raspberry Pi - 2.7"
 output: copy of the screen in file: image.bmp
 """
 
-import json
 import os
 import utils
 import logging
@@ -20,29 +19,29 @@ WHITE = 1
 BLACK = 0
 # Font file: path below if installed with
 # sudo apt install fonts-freefont-ttf
-font_file = './free-sans.ttf'
-if not os.path.isfile(font_file):
-    font_file = '../freefont/FreeSans.ttf'
-    if not os.path.isfile(font_file):
-        displayLogger.error("No font file")
-        exit(1)
+font_files = ['./free-sans.ttf', '../freefont/FreeSans.ttf']
+font_file = None
 # File names
 data_filename = 'data/data.json'
 weather_data_filename = 'data/weather_data.json'
+derived_filename = 'data/derived.json'
 image_filename = 'image.bmp'
 # Global variables
 g_data = dict()
 g_weather_data = dict()
 g_image = None
 
-def read_json(filename):
-    """Read a JSON file to a dict object."""
-    with open(filename, 'r') as f:
-        try:
-            data = json.load(f)
-        except json.decoder.JSONDecodeError:
-            data = dict()
-    return data
+def find_font():
+    """Looks up the font file on first use, not at import time."""
+    global font_file
+    if font_file is None:
+        for candidate in font_files:
+            if os.path.isfile(candidate):
+                font_file = candidate
+                break
+        else:
+            displayLogger.error("No font file")
+    return font_file
 
 def trend_symbol(trend):
     """Unicode symbol for temperature trend"""
@@ -61,7 +60,7 @@ def textsize(text, font):
     return width, height
 
 def draw_image():
-    """Draws the image in memory (g_image)"""
+    """Draws the image in memory (g_image). Returns False when the data files are missing or malformed."""
     global g_data
     global g_weather_data
     global g_image
@@ -77,23 +76,23 @@ def draw_image():
 
     # read data
     if os.path.isfile(data_filename):
-        g_data = read_json(data_filename)
+        g_data = utils.load_json(data_filename)
     else:
         displayLogger.error("No data file")
-        return
+        return False
     if not ("body" in g_data):
         displayLogger.error("Bad data format")
-        return
+        return False
     
     # read weather data
     if os.path.isfile(weather_data_filename):
-        g_weather_data = read_json(weather_data_filename)
+        g_weather_data = utils.load_json(weather_data_filename)
     else:
         displayLogger.error("No weather data file")
-        return
+        return False
     if not ("properties" in g_weather_data):
         displayLogger.error("Bad weather data format")
-        return
+        return False
 
     # Units
     # see https://dev.netatmo.com/en-US/resources/technical/reference/weather/getstationsdata
@@ -155,6 +154,22 @@ def draw_image():
                 # Optional indoor module
                 pass
     
+    # derived metrics (derived.py): feels-like and dew point, pressure tendency and rain rate
+    feels_like_str = ''
+    tendency_str = ''
+    if os.path.isfile(derived_filename):
+        derived_data = utils.load_json(derived_filename)
+        if "feels_like" in derived_data:
+            feels_like_str = "Føles som " + '{0:.1f}'.format(derived_data["feels_like"]) + " " + unit_temp
+        if "dew_point" in derived_data:
+            feels_like_str += " / Duggpunkt " + '{0:.1f}'.format(derived_data["dew_point"]) + " " + unit_temp
+        if derived_data.get("pressure_tendency_3h") is not None:
+            tendency_str = "Trykk " + '{0:+.1f}'.format(derived_data["pressure_tendency_3h"]) + " hPa/3t"
+        if derived_data.get("rain_rate"):
+            if tendency_str:
+                tendency_str += " / "
+            tendency_str += "Regn " + '{0:.1f}'.format(derived_data["rain_rate"]) + " " + unit_rain
+
     # weather forecast
     if "properties" in g_weather_data:
         timeseries = g_weather_data["properties"]["timeseries"]
@@ -217,6 +232,10 @@ def draw_image():
     # outdoor humidity
     draw.text((second_window_x, second_window_y + (4*(txtheight))), outdoor_humidity_str, fill=BLACK, font = font_text)
 
+    # derived metrics
+    draw.text((first_window_x, second_window_y + (4*(txtheight)) - 25), feels_like_str, fill=BLACK, font = font_time)
+    draw.text((second_window_x, second_window_y + (4*(txtheight)) - 25), tendency_str, fill=BLACK, font = font_time)
+
     # time
     draw.text((width - width_time - 5, 5), data_time_str, fill = BLACK, font = font_time)
 
@@ -244,13 +263,16 @@ def draw_image():
     g_image.paste(weather_symbol_3, (780,300), mask=weather_symbol_3)
     draw.text((bottom_window_x+((width/4)*3), bottom_window_y), utils.format_time_str(forecast_24_hours["time"]), fill=BLACK, font = font_text)
     draw.text((bottom_window_x+((width/4)*3), bottom_window_y+30), '{0:.1f}'.format(forecast_24_hours_details["air_temperature_min"]) + unit_temp + " / " + '{0:.1f}'.format(forecast_24_hours_details["air_temperature_max"]) + unit_temp, fill=BLACK, font = font_text)
+    return True
 
 def main():
-    """Main function"""
+    """Main function. Returns True when image.bmp shows the current data."""
     global g_image
 
+    if find_font() is None:
+        return False
     g_image = Image.new('1', (960, 540), WHITE)
-    draw_image()
+    drawn = draw_image()
     humidity = Image.open("symbols/humidity.png")
     #img1 = Image.open("output_bw/01d.png")
     #img2 = Image.open("symbols/rainy.png")
@@ -266,6 +288,7 @@ def main():
     #g_image.paste(img3, (540,300), mask=img3)
     #g_image.paste(img4, (780,300), mask=img4)
     g_image.save(image_filename)
+    return drawn
 
 # main
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+"""event_index.py
+Interval index over the expanded calendar events in events.json.
+"events happening at t", "next N events after t" and "events between a and b"
+are answered in O(log n + k) instead of scanning every event.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import utils
+
+indexLogger = logging.getLogger(__name__)
+
+
+def build_tree(events, indexes):
+    """Centered interval tree over events[indexes].
+    A node is (center, overlapping sorted by start, overlapping sorted by end descending, left, right)."""
+    if not indexes:
+        return None
+    points = sorted(events[i]["start_ts"] for i in indexes)
+    center = points[len(points) // 2]
+    left, right, overlapping = [], [], []
+    for i in indexes:
+        if events[i]["end_ts"] <= center and events[i]["start_ts"] < center:
+            left.append(i)
+        elif events[i]["start_ts"] > center:
+            right.append(i)
+        else:
+            overlapping.append(i)
+    by_start = sorted(overlapping, key=lambda i: events[i]["start_ts"])
+    by_end = sorted(overlapping, key=lambda i: events[i]["end_ts"], reverse=True)
+    return (center, by_start, by_end, build_tree(events, left), build_tree(events, right))
+
+
+class EventIndex:
+    """Static index over events carrying start_ts and end_ts (epoch seconds, end exclusive)."""
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: (event["start_ts"], event["end_ts"]))
+        self.starts = [event["start_ts"] for event in self.events]
+        self.tree = build_tree(self.events, list(range(len(self.events))))
+
+    def __len__(self):
+        return len(self.events)
+
+    def stab(self, t):
+        """Indexes of the events with start_ts <= t < end_ts."""
+        found = []
+        node = self.tree
+        while node is not None:
+            center, by_start, by_end, left, right = node
+            if t < center:
+                for i in by_start:
+                    if self.events[i]["start_ts"] > t:
+                        break
+                    if self.events[i]["end_ts"] > t:
+                        found.append(i)
+                node = left
+            else:
+                for i in by_end:
+                    if self.events[i]["end_ts"] <= t:
+                        break
+                    if self.events[i]["start_ts"] <= t:
+                        found.append(i)
+                node = right
+        return found
+
+    def at(self, t):
+        """Events happening at t."""
+        return [self.events[i] for i in sorted(self.stab(t))]
+
+    def upcoming(self, t, count):
+        """The next count events starting at or after t."""
+        first = bisect.bisect_left(self.starts, t)
+        return self.events[first:first + count]
+
+    def between(self, start, end):
+        """Events overlapping [start, end): those running at start plus those starting inside."""
+        first = bisect.bisect_left(self.starts, start)
+        last = bisect.bisect_left(self.starts, end)
+        running = [i for i in self.stab(start) if i < first]
+        return [self.events[i] for i in sorted(running)] + self.events[first:last]
+
+
+# Global variables
+g_lock = threading.Lock()
+g_index = None
+g_index_source = None
+
+def load_index(filename):
+    """EventIndex over all calendars in an events.json file, rebuilt when the file changes."""
+    global g_index, g_index_source
+    if not os.path.isfile(filename):
+        return EventIndex([])
+    calendars = utils.load_json(filename)
+    with g_lock:
+        # load_json hands out the same object until the file changes
+        if calendars is not g_index_source:
+            events = []
+            for calendar in calendars:
+                for event in calendar.get("events", []):
+                    if "start_ts" in event and "end_ts" in event:
+                        events.append(dict(event, calendar=calendar.get("calendar")))
+            g_index = EventIndex(events)
+            g_index_source = calendars
+            indexLogger.debug("load_index() indexed %d events", len(g_index))
+        return g_index
@@ -0,0 +1,167 @@
+"""forecast_archive.py
+Keeps successive met.no forecast runs and scores them against the
+Netatmo outdoor observations.
+input: met.no locationforecast documents and getstationsdata results
+output: data/forecast_archive.json (runs and running totals),
+        data/forecast_accuracy.json (bias and MAE per lead time)
+"""
+
+import logging
+import os
+import threading
+from array import array
+import utils
+
+archiveLogger = logging.getLogger(__name__)
+
+# JSON file names
+archive_filename = "data/forecast_archive.json"
+accuracy_filename = "data/forecast_accuracy.json"
+
+HOUR = 3600
+# an observation is scored against the forecast for the nearest full hour
+OBSERVATION_TOLERANCE_SECONDS = 15 * 60
+
+# Global variables
+g_lock = threading.Lock()
+g_loaded = False
+# issued time (epoch) -> (first forecast hour (epoch), array of hourly temperatures)
+g_runs = dict()
+# lead time in hours -> [count, sum of errors, sum of absolute errors]
+g_totals = dict()
+g_last_scored_hour = 0
+
+def compact_run(weather_data):
+    """Reduce a met.no document to (issued, start, temperatures).
+    Only the leading run of hourly steps is kept, as a column of floats."""
+    properties = weather_data.get("properties", {})
+    updated_at = properties.get("meta", {}).get("updated_at")
+    timeseries = properties.get("timeseries", [])
+    if not updated_at or not timeseries:
+        return None
+
+    start = utils.parse_utc(timeseries[0]["time"])
+    temperatures = array('d')
+    expected = start
+    for entry in timeseries:
+        details = entry.get("data", {}).get("instant", {}).get("details", {})
+        if utils.parse_utc(entry["time"]) != expected or "air_temperature" not in details:
+            break
+        temperatures.append(details["air_temperature"])
+        expected += HOUR
+    return utils.parse_utc(updated_at), start, temperatures
+
+def outdoor_observation(station_data):
+    """(time_utc, temperature) of the outdoor module, or None."""
+    devices = station_data.get("body", {}).get("devices", [])
+    if not devices:
+        return None
+    for module in devices[0].get("modules", []):
+        if module.get("type") == "NAModule1":
+            dashboard_data = module.get("dashboard_data", {})
+            if "time_utc" in dashboard_data and "Temperature" in dashboard_data:
+                return dashboard_data["time_utc"], dashboard_data["Temperature"]
+    return None
+
+def load_archive():
+    """Loads the archive from disk once. Caller holds g_lock."""
+    global g_loaded, g_last_scored_hour
+    if g_loaded:
+        return
+    g_loaded = True
+    if not os.path.isfile(archive_filename):
+        return
+    archive = utils.read_json(archive_filename)
+    for run in archive.get("runs", []):
+        g_runs[run["issued"]] = (run["start"], array('d', run["temperature"]))
+    for lead, totals in archive.get("totals", {}).items():
+        g_totals[int(lead)] = list(totals)
+    g_last_scored_hour = archive.get("last_scored_hour", 0)
+
+def save_archive():
+    """Writes runs and running totals. Caller holds g_lock."""
+    archive = {
+        "runs": [
+            {"issued": issued, "start": start, "temperature": temperatures.tolist()}
+            for issued, (start, temperatures) in sorted(g_runs.items())
+        ],
+        "totals": {str(lead): totals for lead, totals in sorted(g_totals.items())},
+        "last_scored_hour": g_last_scored_hour,
+    }
+    utils.write_json(archive, archive_filename)
+
+def save_accuracy():
+    """Publishes bias and MAE per lead time from the running totals. Caller holds g_lock."""
+    leads = []
+    for lead, (count, sum_error, sum_abs_error) in sorted(g_totals.items()):
+        leads.append({
+            "lead_hours": lead,
+            "count": count,
+            "bias": round(sum_error / count, 2),
+            "mae": round(sum_abs_error / count, 2),
+        })
+    utils.write_json({"last_scored_hour": g_last_scored_hour, "leads": leads}, accuracy_filename)
+
+def prune_runs():
+    """Drops runs with no forecast hour left to score. Caller holds g_lock."""
+    for issued in [issued for issued, (start, temperatures) in g_runs.items()
+                   if start + (len(temperatures) - 1) * HOUR <= g_last_scored_hour]:
+        del g_runs[issued]
+
+def add_run(weather_data):
+    """Archives a forecast run, keyed by its model update time. Returns False for duplicates."""
+    run = compact_run(weather_data)
+    if run is None:
+        archiveLogger.warning("add_run() forecast without meta.updated_at or timeseries")
+        return False
+    issued, start, temperatures = run
+    with g_lock:
+        load_archive()
+        if issued in g_runs:
+            archiveLogger.debug("add_run() run %s already archived", utils.timestr(issued))
+            return False
+        g_runs[issued] = (start, temperatures)
+        prune_runs()
+        save_archive()
+    archiveLogger.info("Archived forecast run %s (%d hours, %d runs kept)",
+                       utils.timestr(issued), len(temperatures), len(g_runs))
+    return True
+
+def record_observation(station_data):
+    """Scores every archived run against a new outdoor observation.
+    Each forecast hour is scored once, with the first observation close to it."""
+    global g_last_scored_hour
+    observation = outdoor_observation(station_data)
+    if observation is None:
+        return False
+    time_utc, observed = observation
+    hour = (time_utc + HOUR // 2) // HOUR * HOUR
+    if abs(time_utc - hour) > OBSERVATION_TOLERANCE_SECONDS:
+        return False
+
+    with g_lock:
+        load_archive()
+        if hour <= g_last_scored_hour:
+            return False
+
+        # one column pass over all runs: lead time and forecast for this hour
+        issued_times = [issued for issued in g_runs if issued < hour]
+        indexes = [(hour - g_runs[issued][0]) // HOUR for issued in issued_times]
+        pairs = [((hour - issued) // HOUR, g_runs[issued][1][index])
+                 for issued, index in zip(issued_times, indexes)
+                 if 0 <= index < len(g_runs[issued][1])]
+        errors = [(lead, forecast - observed) for lead, forecast in pairs]
+
+        for lead, error in errors:
+            totals = g_totals.setdefault(lead, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += error
+            totals[2] += abs(error)
+
+        g_last_scored_hour = hour
+        prune_runs()
+        save_archive()
+        if errors:
+            save_accuracy()
+    archiveLogger.debug("record_observation() scored %d runs at %s", len(errors), utils.timestr(hour))
+    return True
@@ -0,0 +1,156 @@
+"""freshness.py
+How old the data is, per source (netatmo, weather, calendar), at each hop:
+  observed   upstream time: Netatmo time_utc, met.no updated_at, calendar fetch start
+  fetched    the response arrived
+  persisted  the data file was written
+  rendered   image.bmp was drawn (rendered_observed: the observation it showed;
+             netatmo and weather only, the calendar is not on the display)
+  published  the shared-memory snapshot was published (multi-process mode)
+report() turns the stamps into per-hop lags, the age of the served data and
+of the numbers on the wall, and a staleness verdict per source against
+thresholds from config ("freshness_thresholds", seconds, null to ignore a source).
+A source that is not configured (no caldav_url: no calendar) is never stale.
+"""
+
+import copy
+import logging
+import os
+import threading
+import runtime
+
+freshnessLogger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLDS = {
+    "netatmo": 30 * 60,
+    "weather": 6 * 60 * 60,
+    "calendar": 2 * 60 * 60,
+}
+SOURCES = tuple(DEFAULT_THRESHOLDS)
+# optional sources: only checked when this config key is set
+SOURCE_CONFIG_KEYS = {"calendar": "caldav_url"}
+# drawn on image.bmp by display.py
+RENDERED_SOURCES = ("netatmo", "weather")
+# hop name, from stamp, to stamp
+HOPS = (
+    ("fetch", "observed", "fetched"),
+    ("persist", "fetched", "persisted"),
+    ("render", "persisted", "rendered"),
+    ("publish", "persisted", "published"),
+)
+
+# Global variables
+g_lock = threading.Lock()
+# source -> stamp name -> epoch seconds
+g_stamps = dict((source, dict()) for source in SOURCES)
+# source -> hop -> {"last", "average", "max", "count"}
+g_lag_stats = dict((source, dict()) for source in SOURCES)
+
+def record(source, **stamps):
+    """Sets stamps of a source (None values are ignored) and updates the lag of completed hops."""
+    with g_lock:
+        current = g_stamps[source]
+        if stamps.get("observed") is not None and stamps["observed"] == current.get("observed"):
+            # the same observation fetched again: its hops were measured on first arrival
+            return
+        if stamps.get("observed") is not None:
+            current.pop("seeded", None)
+        current.update((name, t) for name, t in stamps.items() if t is not None)
+        for hop, start, end in HOPS:
+            if stamps.get(end) is not None and start in current and current[end] >= current[start]:
+                record_lag(source, hop, current[end] - current[start])
+
+def record_lag(source, hop, lag):
+    """Caller holds g_lock."""
+    stats = g_lag_stats[source].setdefault(hop, {"last": None, "average": None, "max": None, "count": 0})
+    stats["last"] = round(lag, 1)
+    stats["average"] = round(lag if stats["average"] is None else 0.8 * stats["average"] + 0.2 * lag, 1)
+    stats["max"] = round(max(lag, stats["max"] or lag), 1)
+    stats["count"] += 1
+
+def pending(source, stamp):
+    """True when the source persisted data that has not reached this hop yet."""
+    with g_lock:
+        current = g_stamps[source]
+        return "persisted" in current and not current.get("seeded") and current.get(stamp, 0) < current["persisted"]
+
+def record_render(t=None):
+    """image.bmp was drawn from the current data files."""
+    t = runtime.now() if t is None else t
+    for source in RENDERED_SOURCES:
+        if pending(source, "rendered"):
+            with g_lock:
+                observed = g_stamps[source].get("observed")
+            record(source, rendered=t, rendered_observed=observed)
+
+def record_publish(t=None):
+    """The snapshot was published; counts for the data persisted since the previous one."""
+    t = runtime.now() if t is None else t
+    for source in SOURCES:
+        if pending(source, "published"):
+            record(source, published=t)
+
+def stamps():
+    with g_lock:
+        return copy.deepcopy(g_stamps)
+
+def lag_stats():
+    with g_lock:
+        return copy.deepcopy(g_lag_stats)
+
+def seed(source, observed, persisted):
+    """Stamps of data left by a previous run; its hops were not seen, so no lags are measured."""
+    if observed is None:
+        return
+    with g_lock:
+        if "observed" not in g_stamps[source]:
+            g_stamps[source].update(observed=observed, persisted=persisted, seeded=True)
+
+def seed_from_files():
+    """Stamps from the data files left by a previous run, so /healthz is right from the start."""
+    import utils
+    import netatmo
+    import weather
+    import ical_calendar
+    try:
+        if os.path.isfile(netatmo.data_filename):
+            seed("netatmo", netatmo.observation_time(utils.load_json(netatmo.data_filename)),
+                 os.path.getmtime(netatmo.data_filename))
+        if os.path.isfile(weather.weather_data_filename):
+            meta = utils.load_json(weather.weather_data_filename).get("properties", {}).get("meta", {})
+            if "updated_at" in meta:
+                seed("weather", utils.parse_utc(meta["updated_at"]),
+                     os.path.getmtime(weather.weather_data_filename))
+        if os.path.isfile(ical_calendar.events_filename):
+            mtime = os.path.getmtime(ical_calendar.events_filename)
+            seed("calendar", mtime, mtime)
+    except (ValueError, KeyError):
+        freshnessLogger.warning("seed_from_files() could not read a data file", exc_info=1)
+
+def report(source_stamps, config, now):
+    """Per-source age, hop lags and staleness; status is "degraded" when any source is stale."""
+    thresholds = dict(DEFAULT_THRESHOLDS, **config.get("freshness_thresholds", {}))
+    sources = dict()
+    for source in SOURCES:
+        stamp = source_stamps.get(source, {})
+        configured = source not in SOURCE_CONFIG_KEYS or bool(config.get(SOURCE_CONFIG_KEYS[source]))
+        threshold = thresholds.get(source) if configured else None
+        observed = stamp.get("observed")
+        lags = dict()
+        for hop, start, end in HOPS:
+            if start in stamp and end in stamp and stamp[end] >= stamp[start]:
+                if hop == "render" and stamp.get("rendered_observed") != observed:
+                    # the last render predates the latest data
+                    continue
+                lags[hop] = round(stamp[end] - stamp[start], 1)
+        age = round(now - observed, 1) if observed is not None else None
+        sources[source] = {
+            "observed": observed,
+            "age_seconds": age,
+            "wall_age_seconds": round(now - stamp["rendered_observed"], 1) if "rendered_observed" in stamp else None,
+            "lags": lags,
+            "configured": configured,
+            "threshold_seconds": threshold,
+            "stale": threshold is not None and (age is None or age > threshold),
+        }
+    stale = [source for source in SOURCES if sources[source]["stale"]]
+    return {"status": "degraded" if stale else "ok", "stale": stale, "sources": sources}
@@ -1,91 +1,410 @@
+import functools
 import logging
-import time 
+import os
+import threading
+import time
 
-from caldav import DAVClient
-from datetime import datetime, timedelta
-import pytz
-from icalendar import Calendar
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from datetime import datetime, timedelta, timezone
 from datetime import datetime, date
+from zoneinfo import ZoneInfo
+import freshness
+import runtime
+import scheduler
 import utils
 
 calendarLogger = logging.getLogger(__name__)
 events_filename = "data/events.json"
+calendar_cache_filename = "data/calendar_cache.json"
+UPDATE_INTERVAL_SECONDS = 60 * 60  # 1 time i sekunder
 DEFAULT_CALDAV_TIMEOUT_SECONDS = 30
+DEFAULT_CALDAV_WORKERS = 4
+DEFAULT_CALENDAR_DAYS = 7
+DEFAULT_TIMEZONE = "Europe/Oslo"
+# bump when the cached event format changes, old caches are then discarded
+CALENDAR_CACHE_VERSION = 2
+
+# Discovery is cached between runs and redone after a failure
+g_client = None
+g_calendars = None
+# calendar url -> {"name", "ctag", "sync_token", "objects": {href: {"etag", "events"}}}
+g_cache = None
+# urls of the calendars that did not finish in the previous round; they go first in the next one
+g_skipped = set()
+
+
+# caldav, icalendar and dateutil are imported where they are used, so
+# importing this module does not cost their load time until the first fetch
+
+def ctag_property():
+    """CalendarServer ctag, changes whenever anything in the calendar changes."""
+    from caldav.elements.base import ValuedBaseElement
+
+    class GetCTag(ValuedBaseElement):
+        tag = "{http://calendarserver.org/ns/}getctag"
+    return GetCTag()
 
+def update(config):
+    """One polling cycle. Discovery is redone on the next cycle after a failure."""
+    try:
+        fetch_calendar_events(config)
+        return True
+    except Exception as e:
+        forget_calendars()
+        calendarLogger.error("Error fetching calendar events:", exc_info=1)
+        return False
 
 def calendar_service(config):
     """Fetches calendar events from iCloud and saves them to events.json."""
-    
-    sleep_time = 60 * 60  # 1 time i sekunder
+    service = scheduler.Scheduler()
+    service.add_job("calendar", functools.partial(update, config), interval=UPDATE_INTERVAL_SECONDS)
+    service.run_forever()
+
+def get_calendars(config):
+    """Principal and calendar discovery, done once and reused."""
+    global g_client, g_calendars
+    if g_calendars is None:
+        g_client = runtime.caldav_client(
+            config["caldav_url"],
+            config["apple_id"],
+            config["apple_password"],
+            config.get("caldav_timeout_seconds", DEFAULT_CALDAV_TIMEOUT_SECONDS),
+        )
+        principal = g_client.principal()
+        g_calendars = principal.calendars()
+        calendarLogger.info("Discovered %d calendars", len(g_calendars))
+    return g_calendars
+
+def forget_calendars():
+    """Drops the cached discovery so the next fetch starts from the principal."""
+    global g_client, g_calendars
+    g_client = None
+    g_calendars = None
+
+def load_cache():
+    """Reads the local event cache, once per process."""
+    global g_cache
+    if g_cache is None:
+        g_cache = dict()
+        if os.path.isfile(calendar_cache_filename):
+            cache = utils.read_json(calendar_cache_filename)
+            if cache.get("version") == CALENDAR_CACHE_VERSION:
+                g_cache = cache.get("calendars", {})
+    return g_cache
+
+def save_cache():
+    utils.write_json({"version": CALENDAR_CACHE_VERSION, "calendars": g_cache},
+                     calendar_cache_filename, ensure_ascii=False)
+
+def get_ctag(calendar):
+    from caldav.lib import error
+    try:
+        return calendar.get_property(ctag_property())
+    except error.DAVError:
+        calendarLogger.debug("No ctag for calendar: %s", calendar.name, exc_info=1)
+        return None
 
-    while True:
+def wall_time(value):
+    """Splits an iCalendar date or datetime into (naive wall-clock datetime, tzid).
+    tzid is None for floating times and all-day dates."""
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day), None
+    if value.tzinfo is None:
+        return value, None
+    tzid = getattr(value.tzinfo, "key", None) or getattr(value.tzinfo, "zone", None)
+    if tzid is None:
+        # custom VTIMEZONE without a known name: pin it to UTC
+        value = value.astimezone(timezone.utc)
+        tzid = "UTC"
+    return value.replace(tzinfo=None), tzid
+
+def date_list(component, name, tzid):
+    """RDATE/EXDATE values as wall-clock ISO strings in the event's time zone."""
+    values = component.get(name)
+    if values is None:
+        return []
+    if not isinstance(values, list):
+        values = [values]
+    dates = []
+    for value in values:
+        for dt in value.dts:
+            dt = dt.dt
+            if tzid is not None and isinstance(dt, datetime) and dt.tzinfo is not None:
+                dt = dt.astimezone(ZoneInfo(tzid))
+            dates.append(wall_time(dt)[0].isoformat())
+    return dates
+
+def parse_events(raw_data):
+    """Parses the VEVENTs of one calendar object into recurrence-aware records.
+    Records are expanded into occurrences by expand_events()."""
+    from icalendar import Calendar
+    events_list = []
+    cal = Calendar.from_ical(raw_data)
+
+    for component in cal.walk():
+        if component.name == "VEVENT":
+            summary = str(component.get("summary", "Ingen tittel"))
+            dtstart = component.get("dtstart")
+            dtend = component.get("dtend")
+            location = str(component.get("location", ""))
+
+            if dtstart is None:
+                continue
+            all_day = isinstance(dtstart.dt, date) and not isinstance(dtstart.dt, datetime)
+            start, tzid = wall_time(dtstart.dt)
+
+            if dtend is not None:
+                end = dtend.dt
+                if isinstance(end, datetime) and end.tzinfo is not None and tzid is not None:
+                    end = end.astimezone(ZoneInfo(tzid))
+                duration = wall_time(end)[0] - start
+            elif component.get("duration") is not None:
+                duration = component.get("duration").dt
+            else:
+                duration = timedelta(days=1) if all_day else timedelta(0)
+
+            rrule = component.get("rrule")
+            recurrence_id = component.get("recurrence-id")
+            if recurrence_id is not None:
+                recurrence_dt = recurrence_id.dt
+                if isinstance(recurrence_dt, datetime) and recurrence_dt.tzinfo is not None and tzid is not None:
+                    recurrence_dt = recurrence_dt.astimezone(ZoneInfo(tzid))
+                recurrence_id = wall_time(recurrence_dt)[0].isoformat()
+
+            events_list.append({
+                "uid": str(component.get("uid", "")),
+                "title": summary,
+                "location": location,
+                "all_day": all_day,
+                "tzid": tzid,
+                "start": start.isoformat(),
+                "duration": int(duration.total_seconds()),
+                "rrule": rrule.to_ical().decode() if rrule is not None else None,
+                "rdate": date_list(component, "rdate", tzid),
+                "exdate": date_list(component, "exdate", tzid),
+                "recurrence_id": recurrence_id,
+            })
+    return events_list
+
+def occurrence_starts(record, tz, window_start, window_end):
+    """Start times (aware) of the occurrences of one record that can overlap the window."""
+    from dateutil.rrule import rrulestr, rruleset
+    start = datetime.fromisoformat(record["start"])
+    duration = timedelta(seconds=record["duration"])
+    if not record["rrule"] and not record["rdate"]:
+        return [start.replace(tzinfo=tz)]
+
+    # expand with aware datetimes so DST changes keep the wall-clock time;
+    # a floating or date-only UNTIL only works with a naive DTSTART
+    aware = True
+    if record["rrule"]:
         try:
-            fetch_calendar_events(config)
-        except Exception as e:
-            calendarLogger.error("Error fetching calendar events:", exc_info=1)
+            rrulestr(record["rrule"], dtstart=start.replace(tzinfo=tz))
+        except ValueError:
+            aware = False
 
-        time.sleep(sleep_time)
-        
-def fetch_calendar_events(config):
-    client = DAVClient(
-        url=config["caldav_url"],
-        username=config["apple_id"],
-        password=config["apple_password"],
-        timeout=config.get("caldav_timeout_seconds", DEFAULT_CALDAV_TIMEOUT_SECONDS),
-    )
+    def local(wall):
+        return wall.replace(tzinfo=tz) if aware else wall
+
+    rules = rruleset()
+    if record["rrule"]:
+        rules.rrule(rrulestr(record["rrule"], dtstart=local(start)))
+    else:
+        rules.rdate(local(start))
+    for value in record["rdate"]:
+        rules.rdate(local(datetime.fromisoformat(value)))
+    for value in record["exdate"]:
+        rules.exdate(local(datetime.fromisoformat(value)))
 
-    principal = client.principal()
-    calendars = principal.calendars()
+    low = (window_start - duration).astimezone(tz)
+    high = window_end.astimezone(tz)
+    if not aware:
+        low, high = low.replace(tzinfo=None), high.replace(tzinfo=None)
+    return [value if aware else value.replace(tzinfo=tz)
+            for value in rules.between(low, high, inc=True)]
+
+def expand_events(records, window_start, window_end, default_tz):
+    """Expands parsed records into the occurrences overlapping [window_start, window_end).
+    Times are normalized to epoch seconds; all-day and floating events use default_tz."""
+    overridden = set((record["uid"], record["recurrence_id"])
+                     for record in records if record["recurrence_id"])
+    occurrences = []
+    for record in records:
+        tz = ZoneInfo(record["tzid"]) if record["tzid"] else default_tz
+        recurring = bool(record["rrule"] or record["rdate"])
+        try:
+            starts = occurrence_starts(record, tz, window_start, window_end)
+        except ValueError:
+            calendarLogger.warning("Could not expand event: %s", record["title"], exc_info=1)
+            continue
+        for start in starts:
+            wall = start.replace(tzinfo=None).isoformat()
+            if recurring and (record["uid"], wall) in overridden:
+                continue
+            if record["all_day"]:
+                # all-day events last whole days of wall-clock time
+                end = (start.replace(tzinfo=None) + timedelta(seconds=record["duration"])).replace(tzinfo=tz)
+            else:
+                end = start + timedelta(seconds=record["duration"])
+            start_ts = start.timestamp()
+            end_ts = end.timestamp()
+            if end_ts <= window_start.timestamp() and start_ts < window_start.timestamp():
+                continue
+            if start_ts >= window_end.timestamp():
+                continue
+            occurrences.append({
+                "title": record["title"],
+                "start": start.date().isoformat() if record["all_day"] else start.isoformat(),
+                "end": end.date().isoformat() if record["all_day"] else end.isoformat(),
+                "location": record["location"],
+                "all_day": record["all_day"],
+                "start_ts": int(start_ts),
+                "end_ts": int(end_ts),
+            })
+    return occurrences
+
+def sync_calendar(calendar, state):
+    """Brings the cached objects of one calendar up to date.
+    Returns the new state, or the old one when the ctag says nothing changed."""
+    from caldav.elements import dav
+    ctag = get_ctag(calendar)
+    if ctag is not None and ctag == state.get("ctag"):
+        calendarLogger.info("Calendar unchanged: %s", calendar.name)
+        return state
+
+    sync_token = state.get("sync_token")
+    objects = dict(state.get("objects", {}))
+    updates = calendar.objects_by_sync_token(sync_token=sync_token, load_objects=False)
+    # When the server rejects the token or does not support sync-collection,
+    # caldav lists every object instead and returns a "fake-" token; the same
+    # fake token with an empty listing means nothing changed.
+    fallback = str(updates.sync_token or "").startswith("fake-")
+    full_listing = sync_token is None or (fallback and updates.sync_token != sync_token)
+    if full_listing:
+        if sync_token is not None:
+            calendarLogger.info("No incremental sync, listed all objects of calendar: %s", calendar.name)
+        # whatever is not listed any more was deleted
+        listed = set(str(obj.url) for obj in updates)
+        for href in [href for href in objects if href not in listed]:
+            del objects[href]
+
+    changed = []
+    for obj in updates:
+        href = str(obj.url)
+        etag = getattr(obj, "props", {}).get(dav.GetEtag.tag)
+        if etag is None and not full_listing:
+            # reported without an etag in an incremental sync: deleted
+            objects.pop(href, None)
+        elif etag is None or objects.get(href, {}).get("etag") != etag:
+            changed.append((obj.url, etag))
+
+    if changed:
+        etags = dict((str(obj_url), etag) for obj_url, etag in changed)
+        for obj in calendar.multiget([obj_url for obj_url, etag in changed]):
+            href = str(obj.url)
+            objects[href] = {"etag": etags.pop(href, None), "events": parse_events(obj.data)}
+        # changed objects the server could not return any more
+        for href in etags:
+            objects.pop(href, None)
+    calendarLogger.info("Synced calendar %s: %d changed, %d cached objects",
+                        calendar.name, len(changed), len(objects))
+
+    return {
+        "name": calendar.name,
+        "ctag": ctag,
+        "sync_token": updates.sync_token,
+        "objects": objects,
+    }
+
+def sync_calendars(config, calendars, cache):
+    """Syncs all calendars through a bounded worker pool.
+    Each calendar gets its own deadline, counted from when a worker picks it up.
+    Queued calendars are not started once every worker is stuck on a timed out
+    calendar. Returns url -> new state for the calendars that finished in time;
+    the others keep their cached events for this round and are synced first next time."""
+    global g_skipped
+    deadline = config.get("caldav_timeout_seconds", DEFAULT_CALDAV_TIMEOUT_SECONDS)
+    workers = max(1, min(config.get("caldav_workers", DEFAULT_CALDAV_WORKERS), len(calendars)))
+    started = dict()
+    started_lock = threading.Lock()
+
+    def worker(calendar, state):
+        with started_lock:
+            started[str(calendar.url)] = time.monotonic()
+        calendarLogger.info("Fetching events from calendar: %s", calendar.name)
+        return sync_calendar(calendar, state)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="calendar")
+    futures = dict()
+    # stable sort: the calendars skipped last round first, then in discovery order
+    for calendar in sorted(calendars, key=lambda calendar: str(calendar.url) not in g_skipped):
+        url = str(calendar.url)
+        futures[executor.submit(worker, calendar, cache.get(url, {}))] = calendar
+
+    states = dict()
+    pending = set(futures)
+    # timed out futures still holding a pool thread
+    hung = set()
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            calendar = futures[future]
+            try:
+                states[str(calendar.url)] = future.result()
+            except Exception:
+                calendarLogger.error("Error syncing calendar: %s", calendar.name, exc_info=1)
+        now = time.monotonic()
+        with started_lock:
+            expired = [future for future in pending
+                       if now - started.get(str(futures[future].url), now) > deadline]
+        for future in expired:
+            calendarLogger.warning("Calendar %s timed out after %d s, keeping cached events",
+                                   futures[future].name, deadline)
+            pending.discard(future)
+            hung.add(future)
+        hung = set(future for future in hung if not future.done())
+        if len(hung) >= workers:
+            # queued calendars would wait behind hung workers; cancel() fails for started ones
+            for future in [future for future in pending if future.cancel()]:
+                calendarLogger.warning("Calendar %s not started, all workers are stuck; keeping cached events",
+                                       futures[future].name)
+                pending.discard(future)
+
+    # timed out workers finish in the background, their results are dropped
+    executor.shutdown(wait=False, cancel_futures=True)
+    g_skipped = set(str(calendar.url) for calendar in calendars) - set(states)
+    return states
+
+def fetch_calendar_events(config):
+    calendars = get_calendars(config)
 
     if not calendars:
         calendarLogger.error("Found no calendars.")
         return
 
-    now = datetime.now(pytz.utc)
-    end = now + timedelta(days=7)
+    default_tz = ZoneInfo(config.get("timezone", DEFAULT_TIMEZONE))
+    now = datetime.fromtimestamp(runtime.now(), timezone.utc)
+    end = now + timedelta(days=config.get("calendar_days", DEFAULT_CALENDAR_DAYS))
 
     calendarLogger.info("Fetching events from %s to %s", now.isoformat(), end.isoformat())
 
+    cache = load_cache()
     output = []
+    states = sync_calendars(config, calendars, cache)
+    fetched = runtime.now()
 
     for calendar in calendars:
-        calendarLogger.info("Fetching events from calendar: %s", calendar.name)
-        
-        # 🔥 NY metode (erstatter date_search)
-        results = calendar.search(
-            start=now,
-            end=end,
-            event=True,
-        )
+        url = str(calendar.url)
+        if url in states:
+            cache[url] = states[url]
 
         events_list = []
-
-        for result in results:
-            raw_data = result.data
-            cal = Calendar.from_ical(raw_data)
-
-            for component in cal.walk():
-                if component.name == "VEVENT":
-                    summary = str(component.get("summary", "Ingen tittel"))
-                    dtstart = component.get("dtstart")
-                    dtend = component.get("dtend")
-                    location = str(component.get("location", ""))
-
-                    start_dt = dtstart.dt.isoformat() if dtstart else None
-                    end_dt = dtend.dt.isoformat() if dtend else None
-
-                    if isinstance(dtstart.dt, date) and not isinstance(dtstart.dt, datetime):
-                        continue
-
-                    events_list.append({
-                        "title": summary,
-                        "start": start_dt,
-                        "end": end_dt,
-                        "location": location,
-                    })
+        for cached_object in cache.get(url, {}).get("objects", {}).values():
+            events_list.extend(expand_events(cached_object["events"], now, end, default_tz))
 
         # sorter kronologisk
-        events_list.sort(key=lambda x: x["start"] or "")
+        events_list.sort(key=lambda x: (x["start_ts"], x["end_ts"]))
 
         if len(events_list) > 0:
             output.append({
@@ -96,4 +415,10 @@ def fetch_calendar_events(config):
         else:
             calendarLogger.info("No events found in calendar: %s", calendar.name)
 
+    # calendars that are gone from the account are dropped from the cache
+    for url in [url for url in cache if url not in set(str(calendar.url) for calendar in calendars)]:
+        del cache[url]
+    save_cache()
+
     utils.write_json(output, events_filename, ensure_ascii=False)
+    freshness.record("calendar", observed=now.timestamp(), fetched=fetched, persisted=runtime.now())
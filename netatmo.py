@@ -1,37 +1,59 @@
 #!/usr/bin/env python3
 """netatmo.py
 NetAtmo weather station display
-Every 10 minutes, gets the weather station data to a
-local data.json file, and calls display.py.
+Polls the weather station data just after each expected station upload
+(at most every 10 minutes) into a local data.json file. image.bmp is drawn
+by the render job (render() -> display.py) once new data arrived.
 """
 
+import functools
 import requests
-import time
 import sys
 import os
 import logging
-import display
+from collections import deque
 import utils
 import weather
+import derived
+import forecast_archive
+import freshness
+import ratelimit
+import runtime
+import scheduler
+import token_manager
 
 netatmoLogger = logging.getLogger(__name__)
 
 REQUEST_TIMEOUT = (5, 30)
+# Netatmo per-user quota: 50 requests per 10 s and 500 per hour
+RATE_LIMITS = ((50, 10), (500, 3600))
+RATE_LIMIT_WAIT_SECONDS = 30
 UPDATE_INTERVAL_SECONDS = 600
+# adaptive polling: fetch this long after a station's expected upload,
+# never poll more often than MIN_POLL_SECONDS
+UPLOAD_MARGIN_SECONDS = 30
+MIN_POLL_SECONDS = 30
+UPLOAD_HISTORY = 6
 
 # JSON file names
 token_filename = "config/token.json"
 data_filename = "data/data.json"
 
 # Global variables
-g_token = dict()
 g_data = dict()
+# shared by every caller of the Netatmo API
+g_limiter = ratelimit.RateLimiter(RATE_LIMITS)
+g_coalescer = ratelimit.Coalescer()
+# station id -> {"uploads": recent upload times, "unchanged": polls without new data}
+g_stations = dict()
+# observation-to-fetch lag achieved by the poller
+g_poll_stats = {"polls": 0, "unchanged": 0, "last_lag": None, "average_lag": None, "max_lag": None}
 
 def get_new_token():
     """Instruct the user to authenticate on the dev portal and get a new token."""
     if not os.path.isfile(token_filename):
-        g_token = {"access_token": "xxxx", "refresh_token": "xxxx"}
-        utils.write_json(g_token, token_filename)
+        token = {"access_token": "xxxx", "refresh_token": "xxxx"}
+        utils.write_json(token, token_filename, compact=False, durable=True)
 
     netatmoLogger.error('_______________________________________________________')
     netatmoLogger.error("Please generate a new access token, edit %s,", token_filename)
@@ -53,63 +75,80 @@ def get_new_token():
     netatmoLogger.error('_______________________________________________________')
     sys.exit(1)
 
-def refresh_token(config):
-    """NetAtmo API token refresh. Result: g_token and token.json file."""
-    global g_token
+class RateLimited(requests.exceptions.RequestException):
+    """The client-side quota did not allow the request in time."""
+
+def api_post(url, priority=ratelimit.LIVE, **kwargs):
+    """POST to the Netatmo API within the shared quota.
+    Identical requests already in flight are sent once and share the response."""
+    key = (url, tuple(sorted(kwargs.get("params", {}).items())), tuple(sorted(kwargs.get("data", {}).items())))
+
+    def post():
+        if not g_limiter.acquire(priority, timeout=RATE_LIMIT_WAIT_SECONDS):
+            raise RateLimited("Netatmo request quota exhausted: " + url)
+        return runtime.http_post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+
+    return g_coalescer.do(key, post)
+
+def request_token(config, refresh_token):
+    """NetAtmo API token refresh. Result: the new token, or None.
+    Called through g_tokens, which stores it in token.json."""
     payload = {
         'grant_type': 'refresh_token',
-        'refresh_token': g_token['refresh_token'],
+        'refresh_token': refresh_token,
         'client_id': config['client_id'],
         'client_secret': config['client_secret'],
     }
     try:
-        response = requests.post(
+        response = api_post(
             "https://api.netatmo.com/oauth2/token",
             data=payload,
-            timeout=REQUEST_TIMEOUT,
         )
         netatmoLogger.debug("%d %s", response.status_code, response.text)
         response.raise_for_status()
-        g_token = response.json()
-        utils.write_json(g_token, token_filename)
-        netatmoLogger.info("refresh_token() OK.")
-        return True
+        netatmoLogger.info("request_token() OK.")
+        return response.json()
     except requests.exceptions.HTTPError as e:
-        netatmoLogger.warning("refresh_token() HTTPError")
+        netatmoLogger.warning("request_token() HTTPError")
         netatmoLogger.warning("%d %s", e.response.status_code, e.response.text)
-        netatmoLogger.warning("refresh_token() failed. Need a new access token.")
+        netatmoLogger.warning("request_token() failed. Need a new access token.")
         get_new_token()
-        return False
+        return None
     except requests.exceptions.RequestException:
-        netatmoLogger.error("refresh_token() RequestException", exc_info=1)
-        return False
+        netatmoLogger.error("request_token() RequestException", exc_info=1)
+        return None
+
+# shared by every caller of the Netatmo API
+g_tokens = token_manager.TokenManager(token_filename, request_token)
 
 def get_station_data(config):
     """Gets Netatmo weather station data. Result: g_data and data.json file."""
-    global g_token
     global g_data
     for attempt in range(2):
+        access_token = g_tokens.access_token(config)
         params = {
-            'access_token': g_token['access_token'],
+            'access_token': access_token,
             'device_id': config['device_id']
         }
         try:
-            response = requests.post(
+            response = api_post(
                 "https://api.netatmo.com/api/getstationsdata",
                 params=params,
-                timeout=REQUEST_TIMEOUT,
             )
             netatmoLogger.debug("%d %s", response.status_code, response.text)
             response.raise_for_status()
+            fetched = runtime.now()
             g_data = response.json()
             utils.write_json(g_data, data_filename)
+            freshness.record("netatmo", observed=observation_time(g_data), fetched=fetched, persisted=runtime.now())
+            forecast_archive.record_observation(g_data)
             return True
         except requests.exceptions.HTTPError as e:
             netatmoLogger.warning("get_station_data() HTTPError")
             netatmoLogger.warning("%d %s", e.response.status_code, e.response.text)
             if e.response.status_code == 403 and attempt == 0:
-                netatmoLogger.info("get_station_data() calling refresh_token()")
-                if refresh_token(config):
+                netatmoLogger.info("get_station_data() refreshing the token")
+                if g_tokens.refresh(config, stale_token=access_token):
                     netatmoLogger.info("get_station_data() retrying")
                     continue
             return False
@@ -158,32 +197,12 @@ def display_console():
                         displaystr += " | " + module_name + " " + str(module["dashboard_data"]["Temperature"])
     netatmoLogger.info(displaystr)
 
-def updater_thread(config):
-    global g_token, g_data
-    while True:
-        cycle_started = time.monotonic()
-        try:
-            if get_station_data(config):
-                display_console()
-                try:
-                    display.main()
-                except Exception:
-                    netatmoLogger.error("display.main() failed", exc_info=1)
-        except Exception:
-            netatmoLogger.error("updater_thread() unexpected failure", exc_info=1)
-
-        elapsed = time.monotonic() - cycle_started
-        time.sleep(max(0, UPDATE_INTERVAL_SECONDS - elapsed))
-
-def startNetatmoService(config):
-    """Main function"""
-    global g_token
+def load_state():
+    """Reads the last token and station data."""
     global g_data
 
     # read last token    
-    if os.path.isfile(token_filename):
-        g_token = utils.read_json(token_filename)
-    else:
+    if not g_tokens.load():
         #authenticate()
         netatmoLogger.error("main() error:")
         netatmoLogger.error("Token file not found: creating an empty one.")
@@ -192,6 +211,95 @@ def startNetatmoService(config):
 
     # read last data
     if os.path.isfile(data_filename):
-        g_data = utils.read_json(data_filename)
-    
-    updater_thread(config)
+        g_data = utils.load_json(data_filename)
+
+def observation_time(data):
+    """time_utc of the first station in a getstationsdata result, None without one."""
+    devices = data.get("body", {}).get("devices", [])
+    return devices[0].get("dashboard_data", {}).get("time_utc") if devices else None
+
+def upload_cadence(uploads):
+    """Median interval between the recent uploads of a station."""
+    intervals = sorted(b - a for a, b in zip(uploads, list(uploads)[1:]) if b > a)
+    if not intervals:
+        return UPDATE_INTERVAL_SECONDS
+    return min(max(intervals[len(intervals) // 2], MIN_POLL_SECONDS), UPDATE_INTERVAL_SECONDS)
+
+def track_uploads(data, now):
+    """Records the upload times in a getstationsdata result.
+    Returns True when any station uploaded since the previous poll."""
+    changed = False
+    for device in data.get("body", {}).get("devices", []):
+        dashboard_data = device.get("dashboard_data", {})
+        uploaded = device.get("last_status_store") or dashboard_data.get("time_utc")
+        if uploaded is None:
+            continue
+        station = g_stations.setdefault(device.get("_id"), {"uploads": deque(maxlen=UPLOAD_HISTORY), "unchanged": 0})
+        if station["uploads"] and station["uploads"][-1] >= uploaded:
+            station["unchanged"] += 1
+            continue
+        station["uploads"].append(uploaded)
+        station["unchanged"] = 0
+        changed = True
+        if "time_utc" in dashboard_data:
+            record_lag(now - dashboard_data["time_utc"])
+    return changed
+
+def record_lag(lag):
+    g_poll_stats["last_lag"] = lag
+    if g_poll_stats["average_lag"] is None:
+        g_poll_stats["average_lag"] = lag
+    else:
+        g_poll_stats["average_lag"] = round(0.8 * g_poll_stats["average_lag"] + 0.2 * lag, 1)
+    g_poll_stats["max_lag"] = max(lag, g_poll_stats["max_lag"] or lag)
+    netatmoLogger.info("Observation-to-fetch lag %d s (average %.0f s)", lag, g_poll_stats["average_lag"])
+
+def next_poll_delay(now):
+    """Seconds until the next poll: just after the earliest expected upload,
+    or an exponential backoff while an upload is overdue."""
+    delays = []
+    for station in g_stations.values():
+        if not station["uploads"]:
+            continue
+        expected = station["uploads"][-1] + upload_cadence(station["uploads"]) + UPLOAD_MARGIN_SECONDS
+        if expected > now:
+            delays.append(expected - now)
+        else:
+            delays.append(MIN_POLL_SECONDS * 2 ** max(0, station["unchanged"] - 1))
+    if not delays:
+        return UPDATE_INTERVAL_SECONDS
+    return min(max(min(delays), MIN_POLL_SECONDS), UPDATE_INTERVAL_SECONDS)
+
+def update(config):
+    """One polling cycle. Returns False when the station data could not be fetched,
+    otherwise reschedules itself after the next expected station upload."""
+    if not g_tokens.token:
+        load_state()
+    if not get_station_data(config):
+        return False
+    now = runtime.now()
+    changed = track_uploads(g_data, now)
+    g_poll_stats["polls"] += 1
+    if changed:
+        derived.update(g_data)
+        display_console()
+    else:
+        g_poll_stats["unchanged"] += 1
+        netatmoLogger.info("No new station data since the last poll.")
+    delay = next_poll_delay(now)
+    netatmoLogger.debug("Next poll in %d s", delay)
+    return scheduler.Reschedule(delay, changed=changed)
+
+def render():
+    """Renders image.bmp from the latest data files.
+    display (and Pillow) is imported on the first render."""
+    import display
+    if display.main():
+        freshness.record_render()
+
+def startNetatmoService(config):
+    """Main function"""
+    service = scheduler.Scheduler()
+    service.add_job("netatmo", functools.partial(update, config), interval=UPDATE_INTERVAL_SECONDS)
+    service.add_job("render", render, after=("netatmo",))
+    service.run_forever()
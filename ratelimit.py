@@ -0,0 +1,145 @@
+"""ratelimit.py
+Client-side token-bucket limiter with priority lanes, and coalescing of
+identical in-flight requests.
+Live requests always go before backfill requests, and backfill may not use
+the last BACKFILL_RESERVE of any bucket, so it can never starve live updates.
+"""
+
+import logging
+import runtime
+import threading
+
+ratelimitLogger = logging.getLogger(__name__)
+
+LIVE = "live"
+BACKFILL = "backfill"
+# share of every bucket kept for live requests
+BACKFILL_RESERVE = 0.2
+
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        """capacity requests per period seconds."""
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = runtime.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, needed):
+        """Seconds until the bucket holds needed tokens."""
+        return max(0.0, (needed - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, limits):
+        """limits: iterable of (requests, period seconds), all of which must allow a request."""
+        self.buckets = [TokenBucket(capacity, period) for capacity, period in limits]
+        self.condition = threading.Condition()
+        self.waiting = {LIVE: 0, BACKFILL: 0}
+        self.granted = {LIVE: 0, BACKFILL: 0}
+        self.throttled = {LIVE: 0, BACKFILL: 0}
+        self.rejected = {LIVE: 0, BACKFILL: 0}
+
+    def _needed(self, bucket, priority):
+        if priority == LIVE:
+            return 1
+        return 1 + bucket.capacity * BACKFILL_RESERVE
+
+    def acquire(self, priority=LIVE, timeout=None):
+        """Takes one request from every bucket, waiting up to timeout seconds.
+        Returns False when the quota did not allow the request in time."""
+        deadline = None if timeout is None else runtime.monotonic() + timeout
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                waited = False
+                while True:
+                    now = runtime.monotonic()
+                    for bucket in self.buckets:
+                        bucket.refill(now)
+                    if priority != LIVE and self.waiting[LIVE]:
+                        delay = None
+                    else:
+                        delay = max([bucket.wait_time(self._needed(bucket, priority)) for bucket in self.buckets] + [0])
+                        if delay == 0:
+                            for bucket in self.buckets:
+                                bucket.tokens -= 1
+                            self.granted[priority] += 1
+                            if waited:
+                                self.throttled[priority] += 1
+                            return True
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.rejected[priority] += 1
+                            ratelimitLogger.warning("Rate limit: %s request rejected after waiting", priority)
+                            return False
+                        delay = remaining if delay is None else min(delay, remaining)
+                    waited = True
+                    self.condition.wait(timeout=delay)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def snapshot(self):
+        """Quota usage: remaining requests per bucket and per-lane counters."""
+        with self.condition:
+            now = runtime.monotonic()
+            for bucket in self.buckets:
+                bucket.refill(now)
+            return {
+                "buckets": [{
+                    "capacity": bucket.capacity,
+                    "period": bucket.period,
+                    "remaining": round(bucket.tokens, 2),
+                    "used_fraction": round(1 - bucket.tokens / bucket.capacity, 3),
+                } for bucket in self.buckets],
+                "waiting": dict(self.waiting),
+                "granted": dict(self.granted),
+                "throttled": dict(self.throttled),
+                "rejected": dict(self.rejected),
+            }
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """Runs identical concurrent requests once; the other callers get the same result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
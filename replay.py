@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""replay.py
+Runs the whole pipeline offline against recorded data, on a virtual clock.
+The netatmo, weather, calendar and render jobs are the ones server.py
+registers. They run one after another whenever their virtual due time comes
+up, so a day of updates replays in seconds, and the same recording always
+gives the same image.bmp frames.
+
+Recording directory:
+  netatmo/*.json          getstationsdata responses, served by time_server
+  metno/*.json            locationforecast responses, served by meta.updated_at
+  calendar/<name>/*.ics   CalDAV objects, one directory per calendar
+  config.json             optional, merged over REPLAY_CONFIG
+At virtual time t each endpoint answers with the latest recording from at or
+before t (the earliest one before that). The replay starts at the earliest
+recorded time.
+
+Every job run is a line in <out>/timings.jsonl (virtual time, real seconds,
+result, sha256 of the rendered frame); a summary is printed at the end.
+
+usage:
+  python3 replay.py run RECORDING [--out DIR] [--hours H] [--speed X] [--keep-frames] [--expect TIMINGS]
+  python3 replay.py synth sample_data.json RECORDING [--metno FILE] [--hours H] [--interval S]
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import time
+import runtime
+import utils
+
+replayLogger = logging.getLogger("replay")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUT = "replay_out"
+DEFAULT_HOURS = 24
+DEFAULT_SYNTH_INTERVAL = 600
+# credentials are never checked: nothing leaves the process
+REPLAY_CONFIG = {
+    "client_id": "replay",
+    "client_secret": "replay",
+    "device_id": "replay",
+    "caldav_url": "replay://",
+    "apple_id": "replay",
+    "apple_password": "replay",
+    "fsync_policy": "never",
+}
+REPLAY_TOKEN = {"access_token": "replay", "refresh_token": "replay"}
+# assets display.py loads relative to the working directory
+ASSETS = ("free-sans.ttf", "symbols")
+# Netatmo fields shifted by synth
+SHIFTED_KEYS = ("time_server", "time_utc", "last_status_store", "last_message", "last_seen",
+                "date_max_temp", "date_min_temp", "date_max_wind_str")
+
+
+class VirtualClock:
+    """Clock that only moves when the replay advances it."""
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance_to(self, monotonic):
+        self.elapsed = max(self.elapsed, monotonic)
+
+
+class Recording:
+    def __init__(self, directory):
+        self.directory = directory
+        self.netatmo = self.load(os.path.join(directory, "netatmo"),
+                                 lambda data: data["time_server"])
+        self.metno = self.load(os.path.join(directory, "metno"),
+                               lambda data: utils.parse_utc(data["properties"]["meta"]["updated_at"]))
+        self.calendars = []
+        calendar_directory = os.path.join(directory, "calendar")
+        if os.path.isdir(calendar_directory):
+            for name in sorted(os.listdir(calendar_directory)):
+                path = os.path.join(calendar_directory, name)
+                if os.path.isdir(path):
+                    self.calendars.append(ReplayCalendar(name, path))
+
+    def load(self, directory, timestamp):
+        """Sorted (timestamp, raw bytes) of the JSON files in directory."""
+        responses = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name), "rb") as f:
+                        content = f.read()
+                    responses.append((timestamp(json.loads(content)), content))
+        responses.sort(key=lambda response: response[0])
+        return responses
+
+    def start(self):
+        """Earliest recorded time."""
+        times = [responses[0][0] for responses in (self.netatmo, self.metno) if responses]
+        if not times:
+            raise ValueError("No netatmo/ or metno/ recordings in " + self.directory)
+        return min(times)
+
+    @staticmethod
+    def latest(responses, t):
+        """The latest recording from at or before t, else the earliest one."""
+        if not responses:
+            return None
+        i = bisect.bisect_right([timestamp for timestamp, content in responses], t)
+        return responses[max(i - 1, 0)][1]
+
+
+class ReplayHTTP:
+    """Stands in for requests: answers the Netatmo and met.no endpoints from a recording."""
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.requests = 0
+
+    def response(self, url, content, status=200):
+        import requests
+        self.requests += 1
+        response = requests.models.Response()
+        response.url = url
+        response.status_code = status if content is not None else 404
+        response.reason = "OK" if response.status_code == 200 else "Not Found"
+        response._content = content or b""
+        response.encoding = "utf-8"
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    def get(self, url, **kwargs):
+        if "api.met.no" in url:
+            return self.response(url, Recording.latest(self.recording.metno, runtime.now()))
+        return self.response(url, None)
+
+    def post(self, url, **kwargs):
+        if url.endswith("/oauth2/token"):
+            return self.response(url, json.dumps(REPLAY_TOKEN).encode())
+        if url.endswith("/api/getstationsdata"):
+            return self.response(url, Recording.latest(self.recording.netatmo, runtime.now()))
+        return self.response(url, None)
+
+
+class ReplayObject:
+    def __init__(self, url, etag=None, data=None):
+        from caldav.elements import dav
+        self.url = url
+        self.props = {dav.GetEtag.tag: etag} if etag is not None else {}
+        self.data = data
+
+
+class ReplayListing(list):
+    sync_token = None
+
+
+class ReplayCalendar:
+    """The part of caldav.Calendar that ical_calendar.sync_calendar() uses."""
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.url = "replay://calendar/%s/" % name
+        self.objects = dict()
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".ics"):
+                with open(os.path.join(directory, filename), encoding="utf-8") as f:
+                    self.objects[self.url + filename] = f.read()
+        self.etags = dict((href, hashlib.sha1(data.encode()).hexdigest()) for href, data in self.objects.items())
+        self.ctag = hashlib.sha1("".join(sorted(self.etags.values())).encode()).hexdigest()
+
+    def get_property(self, prop):
+        return self.ctag
+
+    def objects_by_sync_token(self, sync_token=None, load_objects=False):
+        """Like caldav: an unknown token is not an error but a full listing with a
+        "fake-" token, and a fake token that still matches gives an empty listing."""
+        listing = ReplayListing()
+        listing.sync_token = self.ctag
+        if sync_token is not None and sync_token != self.ctag:
+            listing.sync_token = "fake-" + self.ctag
+            if sync_token == listing.sync_token:
+                return listing
+        if sync_token != self.ctag:
+            listing.extend(ReplayObject(href, etag) for href, etag in self.etags.items())
+        return listing
+
+    def multiget(self, urls):
+        return [ReplayObject(str(url), data=self.objects[str(url)]) for url in urls if str(url) in self.objects]
+
+
+class ReplayCalDAV:
+    """Client and principal in one: discovery returns the recorded calendars."""
+
+    def __init__(self, calendar_list):
+        self.calendar_list = calendar_list
+
+    def principal(self):
+        return self
+
+    def calendars(self):
+        return list(self.calendar_list)
+
+
+def frame_digest(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def prepare(out):
+    """Fresh working directory for the pipeline, with the display assets linked in."""
+    if os.path.realpath(out) == os.path.realpath(HERE):
+        raise ValueError("The replay output directory cannot be the repository itself")
+    os.makedirs(out, exist_ok=True)
+    for name in ("data", "config", "frames"):
+        shutil.rmtree(os.path.join(out, name), ignore_errors=True)
+    for name in ("image.bmp", "timings.jsonl"):
+        if os.path.exists(os.path.join(out, name)):
+            os.remove(os.path.join(out, name))
+    for name in ASSETS:
+        if not os.path.lexists(os.path.join(out, name)):
+            os.symlink(os.path.join(HERE, name), os.path.join(out, name))
+
+def summary(runs):
+    seconds = [run["seconds"] for run in runs]
+    return {
+        "runs": len(runs),
+        "failures": len([run for run in runs if not run["ok"]]),
+        "total_seconds": round(sum(seconds), 3),
+        "median_seconds": round(statistics.median(seconds), 4),
+        "max_seconds": round(max(seconds), 4),
+    }
+
+def compare(expected_filename, frames):
+    """Checks the frames against a previous timings.jsonl. Returns the mismatches."""
+    expected = []
+    with open(expected_filename) as f:
+        for line in f:
+            run = json.loads(line)
+            if "frame" in run:
+                expected.append((run["time"], run["frame"]))
+    mismatches = [(want, got) for want, got in zip(expected, frames) if want != got]
+    if len(expected) != len(frames):
+        mismatches.append((("frames", len(expected)), ("frames", len(frames))))
+    return mismatches
+
+def replay(args):
+    recording = Recording(os.path.abspath(args.recording))
+    clock = VirtualClock(recording.start())
+    http = ReplayHTTP(recording)
+    # installed before the service modules are imported: they read the clock at import
+    runtime.install(clock=clock, http=http,
+                    caldav_client=lambda url, username, password, timeout: ReplayCalDAV(recording.calendars))
+
+    config = dict(REPLAY_CONFIG)
+    if os.path.isfile(os.path.join(recording.directory, "config.json")):
+        config.update(utils.read_json(os.path.join(recording.directory, "config.json")))
+
+    expect = os.path.abspath(args.expect) if args.expect else None
+    prepare(args.out)
+    os.chdir(args.out)
+    utils.configure_persistence(config)
+    utils.write_json(REPLAY_TOKEN, "config/token.json", compact=False)
+
+    import scheduler
+    import server
+    logging.root.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    service = server.add_service_jobs(scheduler.Scheduler(seed=0), config)
+
+    end = args.hours * 3600
+    runs = []
+    frames = []
+    cycles = 0
+    wall_started = time.perf_counter()
+    with open("timings.jsonl", "w") as timings:
+        while True:
+            due = service.next_due()
+            if due is None or due > end:
+                break
+            clock.advance_to(due)
+            if args.speed:
+                lag = clock.monotonic() / args.speed - (time.perf_counter() - wall_started)
+                if lag > 0:
+                    time.sleep(lag)
+            cycles += 1
+            for job in service.run_due():
+                run = {
+                    "cycle": cycles,
+                    "time": int(clock.time()),
+                    "utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(clock.time())),
+                    "job": job.name,
+                    "seconds": job.last_duration,
+                    "ok": job.failures == 0 and not job.stopped,
+                }
+                if job.last_error:
+                    run["error"] = job.last_error
+                if job.name == "render" and run["ok"] and os.path.isfile("image.bmp"):
+                    run["frame"] = frame_digest("image.bmp")
+                    frames.append((run["time"], run["frame"]))
+                    if args.keep_frames:
+                        os.makedirs("frames", exist_ok=True)
+                        shutil.copyfile("image.bmp", os.path.join("frames", "%05d.bmp" % len(frames)))
+                runs.append(run)
+                timings.write(json.dumps(run) + "\n")
+    wall_seconds = time.perf_counter() - wall_started
+
+    jobs = dict()
+    for run in runs:
+        jobs.setdefault(run["job"], []).append(run)
+    result = {
+        "recording": recording.directory,
+        "start": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(clock.start)),
+        "virtual_seconds": round(clock.monotonic()),
+        "wall_seconds": round(wall_seconds, 3),
+        "speedup": round(clock.monotonic() / wall_seconds) if wall_seconds > 0 else None,
+        "cycles": cycles,
+        "http_requests": http.requests,
+        "jobs": dict((name, summary(job_runs)) for name, job_runs in sorted(jobs.items())),
+        "frames": len(frames),
+        "frames_sha256": hashlib.sha256("".join(frame for t, frame in frames).encode()).hexdigest(),
+    }
+    print(json.dumps(result, indent=2))
+
+    if expect:
+        mismatches = compare(expect, frames)
+        for want, got in mismatches[:10]:
+            replayLogger.error("Frame mismatch: expected %s, got %s", want, got)
+        if mismatches:
+            return 1
+        replayLogger.warning("All %d frames match %s", len(frames), args.expect)
+    return 0
+
+def shift(data, offset, keys):
+    """Copy of a JSON document with offset added to the integer fields named in keys."""
+    if isinstance(data, dict):
+        return dict((key, value + offset if key in keys and isinstance(value, int) else shift(value, offset, keys))
+                    for key, value in data.items())
+    if isinstance(data, list):
+        return [shift(value, offset, keys) for value in data]
+    return data
+
+def shift_metno(data, offset):
+    """Copy of a met.no document with its update and forecast times moved by offset seconds."""
+    def moved(t):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(utils.parse_utc(t) + offset))
+    data = json.loads(json.dumps(data))
+    meta = data["properties"]["meta"]
+    meta["updated_at"] = moved(meta["updated_at"])
+    for entry in data["properties"]["timeseries"]:
+        entry["time"] = moved(entry["time"])
+    return data
+
+def synth(args):
+    """Builds a recording from one Netatmo response (and optionally one met.no
+    document) by repeating it with shifted timestamps."""
+    sample = utils.read_json(args.sample)
+    count = int(args.hours * 3600 // args.interval) + 1
+    for k in range(count):
+        utils.write_json(shift(sample, k * args.interval, SHIFTED_KEYS),
+                         os.path.join(args.recording, "netatmo", "%05d.json" % k))
+    if args.metno:
+        metno = utils.read_json(args.metno)
+        for k in range(int(args.hours) + 1):
+            utils.write_json(shift_metno(metno, k * 3600),
+                             os.path.join(args.recording, "metno", "%05d.json" % k))
+    replayLogger.warning("Wrote %d Netatmo responses to %s", count, args.recording)
+    return 0
+
+def main():
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Offline replay of recorded service data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="replay a recording")
+    run.add_argument("recording")
+    run.add_argument("--out", default=DEFAULT_OUT, help="working directory (data/, image.bmp, timings.jsonl)")
+    run.add_argument("--hours", type=float, default=DEFAULT_HOURS, help="virtual hours to replay")
+    run.add_argument("--speed", type=float, default=0, help="virtual seconds per real second, 0 = as fast as possible")
+    run.add_argument("--keep-frames", action="store_true", help="copy every frame to frames/")
+    run.add_argument("--expect", help="timings.jsonl of an earlier run; exit 1 when the frames differ")
+    run.add_argument("--verbose", action="store_true")
+    make = commands.add_parser("synth", help="build a recording from one Netatmo response")
+    make.add_argument("sample")
+    make.add_argument("recording")
+    make.add_argument("--metno", help="met.no document, repeated hourly")
+    make.add_argument("--hours", type=float, default=DEFAULT_HOURS)
+    make.add_argument("--interval", type=int, default=DEFAULT_SYNTH_INTERVAL, help="seconds between Netatmo uploads")
+    args = parser.parse_args()
+    if args.command == "run":
+        return replay(args)
+    return synth(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""runtime.py
+Clock and transports used by the services.
+By default these are the system clock, requests and caldav.DAVClient.
+replay.py installs a virtual clock and recorded responses instead, so the
+whole pipeline can run offline and faster than real time.
+"""
+
+import time
+
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+# Global variables
+g_clock = SystemClock()
+# module-like object with get() and post(), requests unless replaced
+g_http = None
+# callable(url, username, password, timeout) returning a CalDAV client
+g_caldav_client = None
+
+def install(clock=None, http=None, caldav_client=None):
+    """Replaces the clock and/or transports for the whole process."""
+    global g_clock, g_http, g_caldav_client
+    if clock is not None:
+        g_clock = clock
+    if http is not None:
+        g_http = http
+    if caldav_client is not None:
+        g_caldav_client = caldav_client
+
+def now():
+    """Epoch seconds."""
+    return g_clock.time()
+
+def monotonic():
+    return g_clock.monotonic()
+
+def http():
+    """The HTTP transport; requests is imported on first use."""
+    global g_http
+    if g_http is None:
+        import requests
+        g_http = requests
+    return g_http
+
+def http_get(url, **kwargs):
+    return http().get(url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http().post(url, **kwargs)
+
+def caldav_client(url, username, password, timeout):
+    if g_caldav_client is not None:
+        return g_caldav_client(url, username, password, timeout)
+    from caldav import DAVClient
+    return DAVClient(url=url, username=username, password=password, timeout=timeout)
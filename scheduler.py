@@ -0,0 +1,220 @@
+"""scheduler.py
+Runs the periodic jobs of all services from one scheduler thread.
+Each job has its own interval and jitter, backs off exponentially while it
+fails, and can be run now or retried immediately. Jobs declared with
+after=(...) run once, after a short settle delay, when any of their source
+jobs succeeded, so a burst of source updates gives a single render/publish.
+"""
+
+import logging
+import random
+import runtime
+import threading
+import time
+
+schedulerLogger = logging.getLogger(__name__)
+
+DEFAULT_RETRY_SECONDS = 30
+DEFAULT_SETTLE_SECONDS = 5
+
+
+class Reschedule:
+    """Returned by a job to pick its own next run time instead of its interval.
+    changed=False means the run produced nothing new: dependent jobs are not triggered."""
+    def __init__(self, delay, changed=True):
+        self.delay = delay
+        self.changed = changed
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter, retry_seconds, max_backoff, after, settle_seconds):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_seconds = retry_seconds
+        self.max_backoff = max_backoff
+        self.after = tuple(after)
+        self.settle_seconds = settle_seconds
+        # state, guarded by the scheduler condition
+        self.next_run = None
+        self.pending_trigger = None
+        self.running = False
+        self.stopped = False
+        self.failures = 0
+        self.runs = 0
+        self.last_run = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_error = None
+
+
+class Scheduler:
+    def __init__(self, seed=None):
+        self.jobs = dict()
+        self.condition = threading.Condition()
+        self.random = random.Random(seed)
+        self.thread = None
+
+    def add_job(self, name, func, interval=None, jitter=0, run_at_start=True,
+                retry_seconds=DEFAULT_RETRY_SECONDS, max_backoff=None,
+                after=(), settle_seconds=DEFAULT_SETTLE_SECONDS):
+        """Registers func under name.
+        interval: seconds between successful runs, None for jobs that only run when triggered.
+        jitter: up to this many seconds are added to every interval.
+        retry_seconds/max_backoff: first retry delay after a failure, doubled per failure
+        up to max_backoff (default 4 intervals).
+        after: names of source jobs whose success triggers this job after settle_seconds.
+        func returns False (or raises) on failure, or a Reschedule to set its next run."""
+        if max_backoff is None:
+            max_backoff = 4 * interval if interval else 3600
+        job = Job(name, func, interval, jitter, retry_seconds, max_backoff, after, settle_seconds)
+        with self.condition:
+            if run_at_start and interval is not None:
+                job.next_run = runtime.monotonic()
+            self.jobs[name] = job
+            self.condition.notify()
+        return job
+
+    def trigger(self, name, delay=0):
+        """Runs a job now (or after delay seconds), regardless of its interval."""
+        with self.condition:
+            self._trigger(self.jobs[name], runtime.monotonic() + delay)
+            self.condition.notify()
+
+    def retry_now(self, name):
+        """Clears a job's backoff and runs it immediately."""
+        with self.condition:
+            job = self.jobs[name]
+            job.failures = 0
+            self._trigger(job, runtime.monotonic())
+            self.condition.notify()
+
+    def _trigger(self, job, when):
+        if job.running:
+            # run again as soon as the current run is done
+            job.pending_trigger = when if job.pending_trigger is None else min(job.pending_trigger, when)
+        elif job.next_run is None or when < job.next_run:
+            job.next_run = when
+
+    def _settle(self, job, now):
+        """Schedules a dependent job; later source updates push it back (debounce)."""
+        when = now + job.settle_seconds
+        if job.running:
+            job.pending_trigger = when
+        else:
+            job.next_run = when
+
+    def jobs_snapshot(self):
+        """Introspection: state and next run time (epoch seconds) of every job."""
+        offset = runtime.now() - runtime.monotonic()
+        with self.condition:
+            return [{
+                "name": job.name,
+                "interval": job.interval,
+                "after": list(job.after),
+                "running": job.running,
+                "stopped": job.stopped,
+                "next_run": round(job.next_run + offset, 1) if job.next_run is not None else None,
+                "last_run": round(job.last_run + offset, 1) if job.last_run is not None else None,
+                "last_success": round(job.last_success + offset, 1) if job.last_success is not None else None,
+                "last_duration": job.last_duration,
+                "failures": job.failures,
+                "runs": job.runs,
+                "last_error": job.last_error,
+            } for job in self.jobs.values()]
+
+    def start(self):
+        """Runs the scheduler in a daemon thread."""
+        self.thread = threading.Thread(target=self.run_forever, name="scheduler", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def next_due(self):
+        """Clock time of the earliest next run, None when no job is scheduled."""
+        with self.condition:
+            waiting = [job.next_run for job in self.jobs.values()
+                       if not job.running and not job.stopped and job.next_run is not None]
+            return min(waiting) if waiting else None
+
+    def run_due(self):
+        """Runs the jobs that are due, one after another in the calling thread,
+        and returns them. Used by replay.py to step the jobs on a virtual clock."""
+        with self.condition:
+            now = runtime.monotonic()
+            due = sorted([job for job in self.jobs.values()
+                          if not job.running and not job.stopped
+                          and job.next_run is not None and job.next_run <= now],
+                         key=lambda job: (job.next_run, job.name))
+            for job in due:
+                job.running = True
+                job.next_run = None
+        for job in due:
+            self._run(job)
+        return due
+
+    def run_forever(self):
+        with self.condition:
+            while True:
+                now = runtime.monotonic()
+                due = [job for job in self.jobs.values()
+                       if not job.running and not job.stopped
+                       and job.next_run is not None and job.next_run <= now]
+                for job in sorted(due, key=lambda job: job.next_run):
+                    job.running = True
+                    job.next_run = None
+                    threading.Thread(target=self._run, args=(job,), name=job.name, daemon=True).start()
+                waiting = [job.next_run for job in self.jobs.values()
+                           if not job.running and not job.stopped and job.next_run is not None]
+                self.condition.wait(timeout=max(0, min(waiting) - now) if waiting else None)
+
+    def _run(self, job):
+        started = runtime.monotonic()
+        timer = time.perf_counter()
+        result = False
+        error = None
+        try:
+            result = job.func()
+        except SystemExit:
+            # the service asked to stop (e.g. no usable token): keep it stopped
+            schedulerLogger.error("Job %s stopped", job.name)
+            with self.condition:
+                job.running = False
+                job.stopped = True
+            return
+        except Exception as e:
+            schedulerLogger.error("Job %s failed", job.name, exc_info=1)
+            error = repr(e)
+        self._finish(job, started, time.perf_counter() - timer, result, error)
+
+    def _finish(self, job, started, duration, result, error):
+        now = runtime.monotonic()
+        ok = result is not False
+        with self.condition:
+            job.running = False
+            job.runs += 1
+            job.last_run = started
+            job.last_duration = round(duration, 3)
+            if ok:
+                job.failures = 0
+                job.last_success = now
+                job.last_error = None
+                if isinstance(result, Reschedule):
+                    job.next_run = now + max(0, result.delay)
+                elif job.interval is not None:
+                    job.next_run = now + job.interval + self.random.uniform(0, job.jitter)
+                if not isinstance(result, Reschedule) or result.changed:
+                    for dependent in self.jobs.values():
+                        if job.name in dependent.after:
+                            self._settle(dependent, now)
+            else:
+                job.failures += 1
+                job.last_error = error or "returned False"
+                delay = min(job.retry_seconds * 2 ** (job.failures - 1), job.max_backoff)
+                job.next_run = now + delay
+                schedulerLogger.warning("Job %s failed %d time(s), retrying in %d s", job.name, job.failures, delay)
+            if job.pending_trigger is not None:
+                if job.next_run is None or job.pending_trigger < job.next_run:
+                    job.next_run = job.pending_trigger
+                job.pending_trigger = None
+            self.condition.notify()
@@ -1,14 +1,24 @@
+import functools
 import http.server
 import json
+import multiprocessing
+import signal
 import socketserver
-import threading
 import socket
-import netatmo
-import weather
-import ical_calendar
+import sys
+import threading
+import event_index
+import freshness
+import runtime
+import scheduler
+import snapshot
 import logging
 import os 
+import time
 import utils
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from zoneinfo import ZoneInfo
 
 logging.basicConfig()
 logging.root.setLevel(logging.INFO)
@@ -16,7 +26,214 @@ logging.root.setLevel(logging.INFO)
 serverLogger = logging.getLogger("server")
 
 g_config = dict()
+g_scheduler = None
+# set once the service modules are imported and their jobs registered
+g_services_ready = threading.Event()
+DEFAULT_PORT = 8000
 REQUEST_SOCKET_TIMEOUT_SECONDS = 10
+DEFAULT_NEXT_EVENTS = 5
+JOB_JITTER_SECONDS = 60
+# multi-process mode (config "http_workers" > 0)
+PUBLISH_INTERVAL_SECONDS = 30
+PUBLISH_SETTLE_SECONDS = 1
+WORKER_CHECK_SECONDS = 1
+# publisher process: the snapshot segment; HTTP worker process: its reader
+g_snapshot_writer = None
+g_snapshot_reader = None
+# /data.json?fields=...&hours=N responses, serialized once per data version
+PROJECTION_CACHE_ENTRIES = 64
+# ?hours= is relative to now, rounded to this
+PROJECTION_TIME_BUCKET_SECONDS = 60
+g_projection_lock = threading.Lock()
+g_projection_version = None
+# (fields, hours, time bucket) -> serialized body, for g_projection_version
+g_projection_cache = dict()
+g_projection_stats = {"hits": 0, "misses": 0}
+# worker process: (snapshot sequence, parsed /data.json) for building projections
+g_snapshot_payload = (None, None)
+# worker process: (snapshot sequence, freshness stamps published with it)
+g_snapshot_freshness = (None, None)
+
+# Service modules are imported by start_services(), after /healthz is up
+netatmo = None
+weather = None
+ical_calendar = None
+forecast_archive = None
+derived = None
+alerts = None
+
+
+def data_payload():
+    """The /data.json document, built from the service output files."""
+    weather_data = {}
+    # Read weather data
+    if os.path.isfile(weather.weather_data_filename):
+        yr_data = utils.load_json(weather.weather_data_filename).get("properties", {}).get("timeseries", [])
+        filtered_weather_data = []
+        index = 0
+        for timeseries in yr_data:
+            if len(yr_data) >= 18 and (index == 0 or index == 6 or index == 12 or index == 18):
+                curr_timeseries = {}
+                curr_timeseries["time"] = timeseries["time"]
+                if "next_6_hours" in timeseries["data"]:
+                    curr_timeseries["summary"] = timeseries["data"]["next_6_hours"]["summary"]["symbol_code"]
+                    curr_timeseries["min_temp"] = timeseries["data"]["next_6_hours"]["details"]["air_temperature_min"]
+                    curr_timeseries["max_temp"] = timeseries["data"]["next_6_hours"]["details"]["air_temperature_max"]
+                    curr_timeseries["precipitation_amount"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount"]
+                    curr_timeseries["precipitation_amount_max"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount_max"]
+                    curr_timeseries["precipitation_amount_min"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount_min"]
+
+                filtered_weather_data.append(curr_timeseries)
+            index += 1
+        if filtered_weather_data:
+            weather_data["yr"] = filtered_weather_data
+    else:
+        serverLogger.error("No weather data file")
+    if os.path.isfile(netatmo.data_filename):
+        netatmo_data = utils.load_json(netatmo.data_filename)
+        filtered_netatmo_data = netatmo_data.get("body", {}).get("devices", [])
+        if filtered_netatmo_data and "dashboard_data" in filtered_netatmo_data[0]:
+            dashboard_data = [dict(filtered_netatmo_data[0]["dashboard_data"], module_type="NAMain")]
+
+            for device in filtered_netatmo_data[0].get("modules", []):
+                if "dashboard_data" in device:
+                    dashboard_data.append(dict(device["dashboard_data"], module_type=device["type"]))
+
+            weather_data["netatmo"] = {}
+            main_unit = dashboard_data[0]
+            weather_data["netatmo"]["indoor_temperature"] = main_unit["Temperature"]
+            weather_data["netatmo"]["indoor_humidity"] = main_unit["Humidity"]
+            for module in dashboard_data[1:]:
+                if module["module_type"] == "NAModule1":
+                    weather_data["netatmo"]["outdoor_temperature"] = module["Temperature"]
+                    weather_data["netatmo"]["outdoor_humidity"] = module["Humidity"]
+                elif module["module_type"] == "NAModule3":
+                    weather_data["netatmo"]["rain"] = module["sum_rain_24"]
+                elif module["module_type"] == "NAModule2":
+                    weather_data["netatmo"]["wind_strength"] = module["WindStrength"]
+                    weather_data["netatmo"]["wind_angle"] = module["WindAngle"]
+        else:
+            serverLogger.warning("Netatmo data file is missing expected keys.")
+    if os.path.isfile(derived.derived_filename):
+        weather_data["derived"] = utils.load_json(derived.derived_filename)
+    if os.path.isfile(ical_calendar.events_filename):
+        calendar_data = utils.load_json(ical_calendar.events_filename)
+        weather_data["events"] = calendar_data
+    return weather_data
+
+def data_version():
+    """Changes whenever one of the /data.json source files changes."""
+    version = []
+    for filename in (weather.weather_data_filename, netatmo.data_filename,
+                     derived.derived_filename, ical_calendar.events_filename):
+        try:
+            stat = os.stat(filename)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def parse_projection(query):
+    """(fields, hours) from ?fields=netatmo.outdoor_temperature,yr&hours=24, None when absent.
+    Raises ValueError for a bad hours value."""
+    fields = None
+    if "fields" in query:
+        fields = tuple(sorted(set(field.strip() for value in query["fields"]
+                                  for field in value.split(",") if field.strip())))
+    hours = None
+    if "hours" in query:
+        hours = int(query["hours"][0])
+        if hours <= 0:
+            raise ValueError("hours must be positive")
+    return fields, hours
+
+def project(value, paths):
+    """Keeps the dotted paths (as tuples) of value, in payload order. Lists are projected per item."""
+    if isinstance(value, (list, tuple)):
+        return [project(item, paths) for item in value]
+    if not isinstance(value, dict):
+        return value
+    groups = dict()
+    for path in paths:
+        groups.setdefault(path[0], []).append(path[1:])
+    projected = dict()
+    for key in value:
+        if key in groups:
+            rest = groups[key]
+            projected[key] = value[key] if () in rest else project(value[key], rest)
+    return projected
+
+def limit_hours(payload, hours, now):
+    """Copy of payload with the forecast and the events limited to the next hours."""
+    limit = now + hours * 3600
+    payload = dict(payload)
+    if "yr" in payload:
+        payload["yr"] = [entry for entry in payload["yr"]
+                         if "time" not in entry or utils.parse_utc(entry["time"]) < limit]
+    if "events" in payload:
+        payload["events"] = [dict(calendar, events=[event for event in calendar.get("events", [])
+                                                    if event.get("start_ts", now) < limit and event.get("end_ts", limit) > now])
+                             for calendar in payload["events"]]
+    return payload
+
+def projected_document(version, load_payload, fields, hours):
+    """Serialized /data.json for one projection. Repeated projections are a
+    dictionary lookup until version changes."""
+    global g_projection_version
+    now = runtime.now()
+    key = (fields, hours, int(now // PROJECTION_TIME_BUCKET_SECONDS) if hours else None)
+    with g_projection_lock:
+        if version != g_projection_version:
+            g_projection_cache.clear()
+            g_projection_version = version
+        body = g_projection_cache.get(key)
+        if body is not None:
+            g_projection_stats["hits"] += 1
+            return body
+        g_projection_stats["misses"] += 1
+
+    payload = load_payload()
+    if hours:
+        payload = limit_hours(payload, hours, now)
+    if fields:
+        payload = project(payload, [tuple(field.split(".")) for field in fields])
+    body = json.dumps(payload).encode('utf-8')
+
+    with g_projection_lock:
+        if version == g_projection_version:
+            if len(g_projection_cache) >= PROJECTION_CACHE_ENTRIES:
+                g_projection_cache.clear()
+            g_projection_cache[key] = body
+    return body
+
+def jobs_payload():
+    return g_scheduler.jobs_snapshot()
+
+def freshness_report(stamps):
+    """Staleness and hop lags per source, as of now."""
+    return freshness.report(stamps, g_config, runtime.now())
+
+def metrics_payload():
+    metrics = {
+        "netatmo_rate_limit": dict(netatmo.g_limiter.snapshot(), coalesced=netatmo.g_coalescer.coalesced),
+        "netatmo_polling": dict(netatmo.g_poll_stats),
+        "persistence": utils.persistence_stats(),
+        "json_cache": utils.json_cache_stats(),
+        "projection_cache": dict(g_projection_stats, entries=len(g_projection_cache)),
+        "alerts": alerts.alerts_stats(),
+        "freshness": dict(freshness_report(freshness.stamps()), lag_stats=freshness.lag_stats()),
+    }
+    if g_snapshot_writer is not None:
+        metrics["snapshot"] = g_snapshot_writer.snapshot_stats()
+    return metrics
+
+# documents built by the service process; in multi-process mode they are
+# published to the HTTP workers through the shared-memory snapshot
+SNAPSHOT_DOCUMENTS = {
+    "/data.json": data_payload,
+    "/jobs.json": jobs_payload,
+    "/metrics.json": metrics_payload,
+}
 
 
 class WeatherHandler(http.server.SimpleHTTPRequestHandler):
@@ -24,77 +241,99 @@ class WeatherHandler(http.server.SimpleHTTPRequestHandler):
         super().setup()
         self.connection.settimeout(REQUEST_SOCKET_TIMEOUT_SECONDS)
 
-    def read_and_process_files(self):
-        weather_data = {}
-        # Read weather data
-        if os.path.isfile(weather.weather_data_filename):
-            yr_data = utils.read_json(weather.weather_data_filename).get("properties", {}).get("timeseries", [])
-            filtered_weather_data = []
-            index = 0
-            for timeseries in yr_data:
-                if len(yr_data) >= 18 and (index == 0 or index == 6 or index == 12 or index == 18):
-                    curr_timeseries = {}
-                    curr_timeseries["time"] = timeseries["time"]
-                    if "next_6_hours" in timeseries["data"]:
-                        curr_timeseries["summary"] = timeseries["data"]["next_6_hours"]["summary"]["symbol_code"]
-                        curr_timeseries["min_temp"] = timeseries["data"]["next_6_hours"]["details"]["air_temperature_min"]
-                        curr_timeseries["max_temp"] = timeseries["data"]["next_6_hours"]["details"]["air_temperature_max"]
-                        curr_timeseries["precipitation_amount"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount"]
-                        curr_timeseries["precipitation_amount_max"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount_max"]
-                        curr_timeseries["precipitation_amount_min"] = timeseries["data"]["next_6_hours"]["details"]["precipitation_amount_min"]
-
-                    filtered_weather_data.append(curr_timeseries)
-                index += 1
-            if filtered_weather_data:
-                weather_data["yr"] = filtered_weather_data
-        else:
-            serverLogger.error("No weather data file")
-        if os.path.isfile(netatmo.data_filename):
-            netatmo_data = utils.read_json(netatmo.data_filename)
-            filtered_netatmo_data = netatmo_data.get("body", {}).get("devices", [])
-            if filtered_netatmo_data and "dashboard_data" in filtered_netatmo_data[0]:
-                dashboard_data = [dict(filtered_netatmo_data[0]["dashboard_data"], module_type="NAMain")]
-
-                for device in filtered_netatmo_data[0].get("modules", []):
-                    if "dashboard_data" in device:
-                        dashboard_data.append(dict(device["dashboard_data"], module_type=device["type"]))
-
-                weather_data["netatmo"] = {}
-                main_unit = dashboard_data[0]
-                weather_data["netatmo"]["indoor_temperature"] = main_unit["Temperature"]
-                weather_data["netatmo"]["indoor_humidity"] = main_unit["Humidity"]
-                for module in dashboard_data[1:]:
-                    if module["module_type"] == "NAModule1":
-                        weather_data["netatmo"]["outdoor_temperature"] = module["Temperature"]
-                        weather_data["netatmo"]["outdoor_humidity"] = module["Humidity"]
-                    elif module["module_type"] == "NAModule3":
-                        weather_data["netatmo"]["rain"] = module["sum_rain_24"]
-                    elif module["module_type"] == "NAModule2":
-                        weather_data["netatmo"]["wind_strength"] = module["WindStrength"]
-                        weather_data["netatmo"]["wind_angle"] = module["WindAngle"]
-            else:
-                serverLogger.warning("Netatmo data file is missing expected keys.")
-        if os.path.isfile(ical_calendar.events_filename):
-            calendar_data = utils.read_json(ical_calendar.events_filename)
-            weather_data["events"] = calendar_data
-        return weather_data
+    def send_body(self, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, payload, status=200, ensure_ascii=True):
+        self.send_body(json.dumps(payload, ensure_ascii=ensure_ascii).encode('utf-8'), status)
+
+    def ready(self):
+        return g_services_ready.is_set()
+
+    def freshness_stamps(self):
+        return freshness.stamps()
+
+    def health(self):
+        """status is "degraded" once a source is older than its freshness threshold."""
+        if not self.ready():
+            return {"status": "ok", "services": "starting"}
+        report = freshness_report(self.freshness_stamps())
+        return {"status": report["status"], "services": "ready", "stale": report["stale"], "sources": report["sources"]}
+
+    def document(self, path):
+        """Serialized document for one of SNAPSHOT_DOCUMENTS, built on request."""
+        return json.dumps(SNAPSHOT_DOCUMENTS[path]()).encode('utf-8')
+
+    def data_document(self, fields, hours):
+        """/data.json, optionally projected, cached until a source file changes."""
+        return projected_document(data_version(), data_payload, fields, hours)
+
+    def query_events(self, query):
+        """Calendar events for /events.json.
+        ?view=now, ?view=next&n=5 or ?view=day&date=YYYY-MM-DD (default: today)."""
+        index = event_index.load_index(ical_calendar.events_filename)
+        view = query.get("view", ["next"])[0]
+        now = runtime.now()
+        try:
+            if view == "now":
+                return index.at(now)
+            if view == "next":
+                return index.upcoming(now, max(0, int(query.get("n", [DEFAULT_NEXT_EVENTS])[0])))
+            if view == "day":
+                tz = ZoneInfo(g_config.get("timezone", ical_calendar.DEFAULT_TIMEZONE))
+                if "date" in query:
+                    day = datetime.strptime(query["date"][0], "%Y-%m-%d").replace(tzinfo=tz)
+                else:
+                    day = datetime.fromtimestamp(now, tz).replace(hour=0, minute=0, second=0, microsecond=0)
+                next_day = (day.replace(tzinfo=None) + timedelta(days=1)).replace(tzinfo=tz)
+                return index.between(day.timestamp(), next_day.timestamp())
+        except ValueError:
+            return None
+        return None
 
     def do_GET(self):
         try:
-            if self.path == "/healthz":
-                payload = {"status": "ok"}
-                self.send_response(200)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps(payload).encode('utf-8'))
+            url = urlsplit(self.path)
+            if url.path == "/healthz":
+                # ?strict=1: 503 while degraded, for probes that only look at the status code
+                health = self.health()
+                strict = parse_qs(url.query).get("strict", ["0"])[0] not in ("0", "")
+                self.send_json(health, status=503 if strict and health["status"] != "ok" else 200)
+                return
+
+            if not self.ready():
+                self.send_json({"status": "starting"}, status=503)
+                return
+
+            if url.path == "/data.json":
+                try:
+                    fields, hours = parse_projection(parse_qs(url.query))
+                except ValueError:
+                    self.send_json({"error": "bad hours value"}, status=400)
+                    return
+                self.send_body(self.data_document(fields, hours))
+                return
+
+            if url.path in SNAPSHOT_DOCUMENTS:
+                self.send_body(self.document(url.path))
+                return
+
+            if url.path == "/events.json":
+                events = self.query_events(parse_qs(url.query))
+                if events is None:
+                    self.send_json({"error": "bad events query"}, status=400)
+                    return
+                self.send_json(events, ensure_ascii=False)
                 return
 
-            if self.path == "/data.json":
-                weather_data = self.read_and_process_files()
-                self.send_response(200)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps(weather_data).encode('utf-8'))
+            if url.path == "/accuracy.json":
+                accuracy = {}
+                if os.path.isfile(forecast_archive.accuracy_filename):
+                    accuracy = utils.load_json(forecast_archive.accuracy_filename)
+                self.send_json(accuracy)
                 return
 
             self.send_response(404)
@@ -103,17 +342,111 @@ class WeatherHandler(http.server.SimpleHTTPRequestHandler):
             serverLogger.warning("Client disconnected before response completed.")
         except Exception:
             serverLogger.error("GET %s failed", self.path, exc_info=1)
-            self.send_response(500)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "internal server error"}).encode('utf-8'))
+            self.send_json({"error": "internal server error"}, status=500)
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
     daemon_threads = True
 
+
+class ReusePortTCPServer(ThreadedTCPServer):
+    """Each HTTP worker binds its own socket to the shared port; the kernel spreads the connections."""
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class SnapshotHandler(WeatherHandler):
+    """HTTP worker handler: serves the documents published by the service process."""
+    def ready(self):
+        return g_snapshot_reader.read()[0] > 0
+
+    def freshness_stamps(self):
+        # parsed once per snapshot; the ages are computed per request
+        global g_snapshot_freshness
+        sequence, documents = g_snapshot_reader.read()
+        if g_snapshot_freshness[0] != sequence:
+            g_snapshot_freshness = (sequence, json.loads(documents["freshness"]))
+        return g_snapshot_freshness[1]
+
+    def health(self):
+        return dict(super().health(), worker=os.getpid(), snapshot=g_snapshot_reader.read()[0])
+
+    def document(self, path):
+        return g_snapshot_reader.read()[1][path]
+
+    def data_document(self, fields, hours):
+        sequence, documents = g_snapshot_reader.read()
+        if fields is None and hours is None:
+            return documents["/data.json"]
+
+        def load_payload():
+            # parsed once per snapshot, shared by all projections of it
+            global g_snapshot_payload
+            if g_snapshot_payload[0] != sequence:
+                g_snapshot_payload = (sequence, json.loads(documents["/data.json"]))
+            return g_snapshot_payload[1]
+        return projected_document(sequence, load_payload, fields, hours)
+
+def serve_worker(port, segment_name, config):
+    """HTTP worker process: answers from the shared-memory snapshot.
+    /events.json and /accuracy.json are still read from the data files."""
+    global g_config, g_snapshot_reader, ical_calendar, forecast_archive
+    import ical_calendar
+    import forecast_archive
+    g_config = config
+    g_snapshot_reader = snapshot.SnapshotReader(segment_name)
+    try:
+        with ReusePortTCPServer(("", port), SnapshotHandler) as httpd:
+            httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def start_worker(port, segment_name, config):
+    # spawned, not forked: the service process has threads running
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve_worker, args=(port, segment_name, config), name="http-worker", daemon=True)
+    process.start()
+    return process
+
+def publish_snapshot(writer):
+    """Serializes SNAPSHOT_DOCUMENTS into the shared-memory segment,
+    with the source freshness stamps the workers report in /healthz."""
+    freshness.record_publish()
+    documents = dict((path, json.dumps(build()).encode('utf-8')) for path, build in SNAPSHOT_DOCUMENTS.items())
+    documents["freshness"] = json.dumps(freshness.stamps()).encode('utf-8')
+    return writer.publish(documents)
+
+def serve_workers(config, port, workers):
+    """Multi-process mode: this process runs the services and publishes the
+    snapshot, workers HTTP processes share the port through SO_REUSEPORT."""
+    global g_snapshot_writer
+    g_snapshot_writer = snapshot.SnapshotWriter(config.get("snapshot_bytes", snapshot.DEFAULT_SIZE))
+    # docker stop: unwind through the finally below so the workers and the segment go away
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    processes = []
+    try:
+        for i in range(workers):
+            processes.append(start_worker(port, g_snapshot_writer.name, config))
+        start_services(config, g_snapshot_writer)
+        while True:
+            time.sleep(WORKER_CHECK_SECONDS)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    serverLogger.warning("HTTP worker %d exited with %s, restarting", process.pid, process.exitcode)
+                    processes[i] = start_worker(port, g_snapshot_writer.name, config)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        g_snapshot_writer.close()
+
 def main():
+    global g_config, g_scheduler
     serverLogger.info("Starting server...")
 
     config = {}
@@ -122,35 +455,84 @@ def main():
     # read config
     if os.path.isfile(config_filename):
         config = utils.read_json(config_filename)
+        g_config = config
+        utils.configure_persistence(config)
     else:
         config = {'client_id': 'xxxx', 'client_secret': 'xxxx', 'device_id': 'xxxx'}
-        utils.write_json(config, config_filename)
+        utils.write_json(config, config_filename, compact=False, durable=True)
         serverLogger.error("main() error:")
         serverLogger.error("Config file not found: creating an empty one.")
         serverLogger.error("Please edit %s and try again.", config_filename)
         return
 
-    # Start netatmo service in background thread
-    netatmo_thread = threading.Thread(target=netatmo.startNetatmoService, args=(config,), daemon=True)
-    netatmo_thread.start()
-    serverLogger.info("Netatmo service started.")
-
-    # Start weather data retrieval in background thread
-    weather_thread = threading.Thread(target=weather.startWeatherService, daemon=True)
-    weather_thread.start()
-    serverLogger.info("Weather service started.")
+    port = config.get("port", DEFAULT_PORT)
+    workers = config.get("http_workers", 0)
+    if workers and not hasattr(socket, "SO_REUSEPORT"):
+        serverLogger.warning("SO_REUSEPORT is not available, serving from a single process.")
+        workers = 0
+    if workers:
+        serverLogger.info(f"Serving at http://0.0.0.0:{port}/data.json from {workers} HTTP worker processes")
+        serve_workers(config, port, workers)
+        return
 
-    # Start calendar data retrieval in background thread
-    calendar_thread = threading.Thread(target=ical_calendar.calendar_service, args=(config,), daemon=True)
-    calendar_thread.start()
-    serverLogger.info("Calendar service started.")
+    # services load in the background, the HTTP server answers /healthz meanwhile
+    threading.Thread(target=start_services, args=(config,), name="services", daemon=True).start()
 
     # start web server
-    PORT = 8000
-    serverLogger.info(f"Serving at http://0.0.0.0:{PORT}/data.json")
-    serverLogger.info(f"Health check available at http://0.0.0.0:{PORT}/healthz")
-    with ThreadedTCPServer(("", PORT), WeatherHandler) as httpd:
+    serverLogger.info(f"Serving at http://0.0.0.0:{port}/data.json")
+    serverLogger.info(f"Health check available at http://0.0.0.0:{port}/healthz")
+    with ThreadedTCPServer(("", port), WeatherHandler) as httpd:
         httpd.serve_forever()
 
+def add_service_jobs(service, config):
+    """Imports the service modules and registers their jobs with service.
+    replay.py registers the same jobs on its virtual clock."""
+    global netatmo, weather, ical_calendar, forecast_archive, derived, alerts
+    import netatmo
+    import weather
+    import ical_calendar
+    import forecast_archive
+    import derived
+    import alerts
+
+    service.add_job("netatmo", functools.partial(netatmo.update, config),
+                    interval=netatmo.UPDATE_INTERVAL_SECONDS)
+    serverLogger.info("Netatmo service started.")
+    service.add_job("weather", weather.update,
+                    interval=weather.UPDATE_INTERVAL_SECONDS, jitter=JOB_JITTER_SECONDS)
+    serverLogger.info("Weather service started.")
+    service.add_job("calendar", functools.partial(ical_calendar.update, config),
+                    interval=ical_calendar.UPDATE_INTERVAL_SECONDS, jitter=JOB_JITTER_SECONDS)
+    serverLogger.info("Calendar service started.")
+    # one render after netatmo and/or weather updated
+    service.add_job("render", netatmo.render, after=("netatmo", "weather"))
+    if config.get("alerts", {}).get("rules"):
+        # after each update, and periodically so station.age_seconds keeps moving
+        service.add_job("alerts", functools.partial(alerts.update, config),
+                        interval=alerts.EVALUATE_INTERVAL_SECONDS, after=("netatmo", "weather"),
+                        settle_seconds=1)
+    if config.get("fsync_policy") == "batched":
+        # files written by an idle producer are synced without waiting for its next write
+        service.add_job("flush", utils.flush_writes,
+                        interval=config.get("fsync_batch_seconds", utils.DEFAULT_FSYNC_BATCH_SECONDS))
+    return service
+
+def start_services(config, writer=None):
+    """Imports the service modules and starts their jobs under one scheduler.
+    With a snapshot writer, a publish job refreshes the shared-memory snapshot."""
+    global g_scheduler
+    started = time.monotonic()
+    # All services run as jobs of one scheduler
+    service = add_service_jobs(scheduler.Scheduler(), config)
+    freshness.seed_from_files()
+    if writer is not None:
+        service.add_job("publish", functools.partial(publish_snapshot, writer),
+                        interval=PUBLISH_INTERVAL_SECONDS, after=("netatmo", "weather", "calendar"),
+                        settle_seconds=PUBLISH_SETTLE_SECONDS)
+    g_scheduler = service
+    service.start()
+    g_services_ready.set()
+    serverLogger.info("Services ready in %.2f s", time.monotonic() - started)
+
 if __name__ == "__main__":
     main()
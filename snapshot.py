@@ -0,0 +1,116 @@
+"""snapshot.py
+Shared-memory snapshot of the serialized HTTP documents (/data.json, ...).
+The publisher process writes all documents into one segment guarded by a
+sequence counter (seqlock): the counter is odd while a write is in progress
+and even once it is complete. HTTP worker processes copy the bytes out and
+retry when the counter moved underneath them, so they serve the latest
+documents without IPC round trips or reparsing.
+"""
+
+import logging
+import struct
+import threading
+from multiprocessing import shared_memory
+
+snapshotLogger = logging.getLogger(__name__)
+
+# sequence, payload length
+HEADER = struct.Struct("<QQ")
+# per document: name length, body length, then name and body
+ENTRY = struct.Struct("<HI")
+DEFAULT_SIZE = 8 * 1024 * 1024
+READ_RETRIES = 1000
+
+
+def encode(documents):
+    parts = []
+    for name, body in documents.items():
+        name = name.encode("utf-8")
+        parts += [ENTRY.pack(len(name), len(body)), name, body]
+    return b"".join(parts)
+
+def decode(payload):
+    documents = dict()
+    offset = 0
+    while offset < len(payload):
+        name_length, body_length = ENTRY.unpack_from(payload, offset)
+        offset += ENTRY.size
+        name = payload[offset:offset + name_length].decode("utf-8")
+        offset += name_length
+        documents[name] = payload[offset:offset + body_length]
+        offset += body_length
+    return documents
+
+
+class SnapshotWriter:
+    """Owns the segment. Only one process (the publisher) writes."""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + size)
+        self.name = self.memory.name
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.stats = {"published": 0, "bytes": 0, "oversized": 0}
+        HEADER.pack_into(self.memory.buf, 0, 0, 0)
+
+    def publish(self, documents):
+        """Replaces the snapshot with documents (name -> bytes). Returns False when it does not fit."""
+        payload = encode(documents)
+        if HEADER.size + len(payload) > self.memory.size:
+            snapshotLogger.error("Snapshot of %d bytes does not fit the %d byte segment",
+                                 len(payload), self.memory.size - HEADER.size)
+            self.stats["oversized"] += 1
+            return False
+        with self.lock:
+            buf = self.memory.buf
+            # odd: readers retry until the write is complete
+            self.sequence += 1
+            HEADER.pack_into(buf, 0, self.sequence, 0)
+            buf[HEADER.size:HEADER.size + len(payload)] = payload
+            self.sequence += 1
+            HEADER.pack_into(buf, 0, self.sequence, len(payload))
+            self.stats["published"] += 1
+            self.stats["bytes"] = len(payload)
+        return True
+
+    def snapshot_stats(self):
+        return dict(self.stats, sequence=self.sequence, segment_bytes=self.memory.size)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SnapshotReader:
+    """Attaches to the publisher's segment; used by the HTTP workers."""
+
+    def __init__(self, name):
+        # processes started by multiprocessing share the publisher's resource
+        # tracker, so attaching here does not unlink the segment on exit
+        self.memory = shared_memory.SharedMemory(name=name)
+        # (sequence, documents), replaced as a whole so handler threads see a consistent pair
+        self.current = (0, dict())
+        self.retries = 0
+
+    def read(self):
+        """Latest (sequence, documents). Documents are decoded once per sequence;
+        while the publisher keeps writing, the previous snapshot is returned."""
+        buf = self.memory.buf
+        current = self.current
+        for attempt in range(READ_RETRIES):
+            sequence, length = HEADER.unpack_from(buf, 0)
+            if sequence == current[0]:
+                return current
+            if sequence % 2:
+                self.retries += 1
+                continue
+            payload = bytes(buf[HEADER.size:HEADER.size + length])
+            if HEADER.unpack_from(buf, 0)[0] != sequence:
+                self.retries += 1
+                continue
+            current = self.current = (sequence, decode(payload))
+            return current
+        return current
+
+    def close(self):
+        self.memory.close()
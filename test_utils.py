@@ -0,0 +1,44 @@
+"""test_utils.py
+Copies of the read-only views returned by utils.load_json.
+Run with: python3 -m pytest test_utils.py
+"""
+
+import copy
+import pickle
+import pytest
+import utils
+
+
+def frozen(tmp_path):
+    filename = str(tmp_path / "data.json")
+    utils.write_json({"body": {"devices": [{"_id": "a", "modules": [{"type": "NAModule1"}]}]}}, filename)
+    return utils.load_json(filename)
+
+def test_frozen_is_read_only(tmp_path):
+    data = frozen(tmp_path)
+    with pytest.raises(TypeError):
+        data["body"] = None
+    with pytest.raises(TypeError):
+        data["body"]["devices"][0]["_id"] = "b"
+
+def test_deepcopy_is_plain_and_mutable(tmp_path):
+    data = frozen(tmp_path)
+    copied = copy.deepcopy(data)
+    assert type(copied) is dict
+    assert type(copied["body"]["devices"]) is list
+    copied["body"]["devices"][0]["modules"].append({"type": "NAModule2"})
+    assert copied != data
+    assert len(data["body"]["devices"][0]["modules"]) == 1
+
+def test_copy_is_shallow_dict(tmp_path):
+    data = frozen(tmp_path)
+    copied = copy.copy(data)
+    assert type(copied) is dict
+    copied["extra"] = 1
+    assert "extra" not in data
+
+def test_pickle_round_trip(tmp_path):
+    data = frozen(tmp_path)
+    loaded = pickle.loads(pickle.dumps(data))
+    assert type(loaded) is dict
+    assert loaded == utils.read_json(str(tmp_path / "data.json"))
@@ -0,0 +1,84 @@
+"""token_manager.py
+OAuth token holder shared by every Netatmo caller.
+The access token is refreshed REFRESH_AHEAD_SECONDS before it expires,
+concurrent callers share one in-flight refresh, and the token file is
+replaced atomically after each refresh.
+"""
+
+import logging
+import os
+import runtime
+import threading
+import utils
+
+tokenLogger = logging.getLogger(__name__)
+
+REFRESH_AHEAD_SECONDS = 300
+
+
+class TokenManager:
+    def __init__(self, filename, request_token):
+        """request_token(config, refresh_token) returns the new token dict, or None on failure."""
+        self.filename = filename
+        self.request_token = request_token
+        self.token = dict()
+        self.condition = threading.Condition()
+        self.refreshing = False
+        self.last_refresh_ok = False
+
+    def load(self):
+        """Reads the token file. Returns False when there is none."""
+        if not os.path.isfile(self.filename):
+            return False
+        with self.condition:
+            self.token = utils.read_json(self.filename)
+        return True
+
+    def expires_in(self):
+        """Seconds left on the access token, None when the expiry is unknown."""
+        with self.condition:
+            expires_at = self.token.get("expires_at")
+        if expires_at is None:
+            return None
+        return expires_at - runtime.now()
+
+    def access_token(self, config):
+        """Current access token, refreshed first when it is about to expire."""
+        with self.condition:
+            observed = self.token.get("access_token")
+            expires_at = self.token.get("expires_at")
+        if expires_at is not None and expires_at - runtime.now() < REFRESH_AHEAD_SECONDS:
+            tokenLogger.info("Access token expires in %d s, refreshing.", max(0, expires_at - runtime.now()))
+            # a caller that refreshed since we looked has replaced the observed token
+            self.refresh(config, stale_token=observed)
+        with self.condition:
+            return self.token.get("access_token")
+
+    def refresh(self, config, stale_token=None):
+        """Refreshes the token once for all concurrent callers.
+        With stale_token, nothing is done when another caller already replaced it."""
+        with self.condition:
+            if stale_token is not None and self.token.get("access_token") != stale_token:
+                return True
+            if self.refreshing:
+                while self.refreshing:
+                    self.condition.wait()
+                return self.last_refresh_ok
+            self.refreshing = True
+            refresh_token = self.token.get("refresh_token")
+
+        token = None
+        try:
+            token = self.request_token(config, refresh_token)
+            if token is not None:
+                if "expires_in" in token:
+                    token["expires_at"] = int(runtime.now()) + token["expires_in"]
+                utils.write_json(token, self.filename, compact=False, durable=True)
+        finally:
+            with self.condition:
+                if token is not None:
+                    self.token = token
+                self.last_refresh_ok = token is not None
+                self.refreshing = False
+                self.condition.notify_all()
+        return token is not None
@@ -1,11 +1,36 @@
+import atexit
+import calendar
+import hashlib
 import json
 import logging
 import os
 import tempfile
+import threading
 import time
 
 utilsLogger = logging.getLogger(__name__)
 
+FSYNC_POLICIES = ("always", "batched", "never")
+DEFAULT_FSYNC_BATCH_SECONDS = 300
+
+# write_json settings and state
+g_persistence_lock = threading.Lock()
+g_persistence = {
+    "compact": False,
+    "fsync_policy": "always",
+    "fsync_batch_seconds": DEFAULT_FSYNC_BATCH_SECONDS,
+    "dirty": set(),
+    "last_flush": time.monotonic(),
+}
+# filename -> (sha1 of the written bytes, mtime_ns, size)
+g_digests = dict()
+g_stats = {"writes": 0, "skipped": 0, "bytes_written": 0, "fsyncs": 0, "seconds": 0.0}
+
+# load_json cache: filename -> ((mtime_ns, size), frozen data)
+g_json_cache_lock = threading.Lock()
+g_json_cache = dict()
+g_json_cache_stats = {"hits": 0, "misses": 0, "primed": 0}
+
 def read_json(filename):
     """Read a JSON file to a dict object."""
     with open(filename, 'r') as f:
@@ -16,21 +41,205 @@ def read_json(filename):
             data = dict()
     return data
 
-def write_json(data, filename, ensure_ascii=True):
-    """Write a dict object to a JSON file atomically."""
+class FrozenDict(dict):
+    """Read-only dict handed out by load_json, so callers cannot corrupt the cache.
+    dict(frozen) and copy.copy() give a shallow mutable copy, copy.deepcopy() and
+    pickle plain dicts and lists all the way down; json.dumps works as for a dict."""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached JSON is read-only, copy it first")
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (thaw(self),))
+
+def freeze(data):
+    """Deep read-only copy of parsed JSON: dicts become FrozenDicts, lists tuples."""
+    if isinstance(data, dict):
+        return FrozenDict((key, freeze(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return tuple(freeze(value) for value in data)
+    return data
+
+def thaw(data):
+    """Mutable deep copy of frozen JSON: plain dicts and lists."""
+    if isinstance(data, dict):
+        return dict((key, thaw(value)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return [thaw(value) for value in data]
+    return data
+
+def load_json(filename):
+    """Read a JSON file through the shared cache.
+    Files are parsed again only when their (mtime, size) changes; the result
+    is a read-only view shared by all callers (see FrozenDict)."""
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with g_json_cache_lock:
+        cached = g_json_cache.get(filename)
+        if cached is not None and cached[0] == key:
+            g_json_cache_stats["hits"] += 1
+            return cached[1]
+        g_json_cache_stats["misses"] += 1
+    data = freeze(read_json(filename))
+    with g_json_cache_lock:
+        g_json_cache[filename] = (key, data)
+    return data
+
+def prime_json_cache(data, filename, stat):
+    """Stores data just written to filename, so the next load_json does not parse it.
+    Only files that are read through load_json are primed."""
+    with g_json_cache_lock:
+        if filename not in g_json_cache:
+            return
+    frozen = freeze(data)
+    with g_json_cache_lock:
+        g_json_cache[filename] = ((stat.st_mtime_ns, stat.st_size), frozen)
+        g_json_cache_stats["primed"] += 1
+
+def json_cache_stats():
+    with g_json_cache_lock:
+        return dict(g_json_cache_stats, files=len(g_json_cache))
+
+def configure_persistence(config):
+    """Applies the persistence settings from config.json:
+    json_compact (bool): compact encoding for generated files,
+    fsync_policy: "always", "batched" (every fsync_batch_seconds) or "never"."""
+    policy = config.get("fsync_policy", "always")
+    if policy not in FSYNC_POLICIES:
+        utilsLogger.warning("Unknown fsync_policy %s, using always", policy)
+        policy = "always"
+    with g_persistence_lock:
+        g_persistence["compact"] = bool(config.get("json_compact", False))
+        g_persistence["fsync_policy"] = policy
+        g_persistence["fsync_batch_seconds"] = config.get("fsync_batch_seconds", DEFAULT_FSYNC_BATCH_SECONDS)
+
+def encode_json(data, compact=False, ensure_ascii=True):
+    if compact:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=ensure_ascii).encode('utf-8')
+    return json.dumps(data, indent=2, ensure_ascii=ensure_ascii).encode('utf-8')
+
+def file_digest(filename, size):
+    """sha1 of a file on disk, None when it is missing or has another size."""
+    try:
+        if os.path.getsize(filename) != size:
+            return None
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).digest()
+    except OSError:
+        return None
+
+def fsync_path(path):
+    """fsyncs one file, or a directory so that renames in it are on disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def flush_writes():
+    """fsyncs the files written since the last flush and their directories (batched policy).
+    Runs on write_json once fsync_batch_seconds passed, from the server's flush job and at exit."""
+    with g_persistence_lock:
+        dirty = g_persistence["dirty"]
+        g_persistence["dirty"] = set()
+        g_persistence["last_flush"] = time.monotonic()
+    fsyncs = 0
+    for path in sorted(dirty) + sorted(set(os.path.dirname(filename) or "." for filename in dirty)):
+        try:
+            fsync_path(path)
+            fsyncs += 1
+        except OSError:
+            # replaced or removed since it was written; its successor is dirty itself
+            utilsLogger.debug("flush_writes() could not fsync %s", path, exc_info=1)
+    with g_persistence_lock:
+        g_stats["fsyncs"] += fsyncs
+
+atexit.register(flush_writes)
+
+def write_json(data, filename, ensure_ascii=True, compact=None, durable=False):
+    """Write a dict object to a JSON file atomically.
+    Nothing is written when the file already holds the same bytes.
+    compact=None uses the configured json_compact setting; pass False for
+    files people edit by hand. durable=True fsyncs the file and its directory
+    whatever the fsync_policy, for config and credentials that cannot be
+    fetched again. Returns True when the file was written."""
+    started = time.perf_counter()
+    if compact is None:
+        compact = g_persistence["compact"]
+    payload = encode_json(data, compact=compact, ensure_ascii=ensure_ascii)
+    digest = hashlib.sha1(payload).digest()
+
+    # the remembered digest is only trusted while the file is untouched
+    with g_persistence_lock:
+        known = g_digests.get(filename)
+    try:
+        stat = os.stat(filename)
+        if known is None or known[1:] != (stat.st_mtime_ns, stat.st_size):
+            known = (file_digest(filename, len(payload)), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        known = None
+    if known is not None and known[0] == digest:
+        with g_persistence_lock:
+            g_stats["skipped"] += 1
+            g_stats["seconds"] += time.perf_counter() - started
+        return False
+
     directory = os.path.dirname(filename) or "."
     os.makedirs(directory, exist_ok=True)
+    policy = "always" if durable else g_persistence["fsync_policy"]
 
-    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=ensure_ascii)
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+        f.write(payload)
         f.flush()
-        os.fsync(f.fileno())
+        if policy == "always":
+            os.fsync(f.fileno())
         temp_filename = f.name
 
     os.replace(temp_filename, filename)
+    if durable:
+        # the rename itself is only on disk once the directory is synced
+        fsync_path(directory)
+    stat = os.stat(filename)
+    prime_json_cache(data, filename, stat)
+
+    flush = False
+    with g_persistence_lock:
+        g_digests[filename] = (digest, stat.st_mtime_ns, stat.st_size)
+        g_stats["writes"] += 1
+        g_stats["bytes_written"] += len(payload)
+        if policy == "always":
+            g_stats["fsyncs"] += 1
+        elif policy == "batched":
+            g_persistence["dirty"].add(filename)
+            flush = time.monotonic() - g_persistence["last_flush"] >= g_persistence["fsync_batch_seconds"]
+    if flush:
+        flush_writes()
+    with g_persistence_lock:
+        g_stats["seconds"] += time.perf_counter() - started
+    return True
+
+def persistence_stats():
+    """Counters for write_json: writes, skipped unchanged writes, bytes, fsyncs, time spent."""
+    with g_persistence_lock:
+        return dict(g_stats,
+                    seconds=round(g_stats["seconds"], 3),
+                    fsync_policy=g_persistence["fsync_policy"],
+                    compact=g_persistence["compact"],
+                    pending_fsync=len(g_persistence["dirty"]))
 
 def timestr(t):
     return time.strftime("%H:%M",time.localtime(t))
 
 def format_time_str(t):
     return t.split("T")[0] + " " + t.split("T")[1][0:5]
+
+def parse_utc(t):
+    """Parse a met.no style UTC timestamp ("2024-01-01T12:00:00Z") to epoch seconds."""
+    return calendar.timegm(time.strptime(t, "%Y-%m-%dT%H:%M:%SZ"))
@@ -1,13 +1,17 @@
 # https://api.met.no/weatherapi/locationforecast/2.0/compact?altitude=353&lat=60.70833400000004&lon=10.611503000000067
 import requests
 import utils
+import forecast_archive
+import freshness
 import logging
-import time
+import runtime
+import scheduler
 
 weatherLogger = logging.getLogger(__name__)
 
 weather_data_filename = "data/weather_data.json"
 REQUEST_TIMEOUT = (5, 30)
+UPDATE_INTERVAL_SECONDS = 60 * 60
 
 def get_weather_data():
     """Gets weather data from met.no API. Result: weather_data.json file."""
@@ -20,7 +24,7 @@ def get_weather_data():
         'lon': '10.611503000000067'
     }
     try:
-        response = requests.get(
+        response = runtime.http_get(
             "https://api.met.no/weatherapi/locationforecast/2.0/complete",
             params=params,
             headers={"User-Agent": "netatmo-weather-app/1.0"},
@@ -28,20 +32,31 @@ def get_weather_data():
         )
         weatherLogger.debug("%d %s", response.status_code, response.text)
         response.raise_for_status()
+        fetched = runtime.now()
         weather_data = response.json()
-        utils.write_json(weather_data, weather_data_filename)    
+        utils.write_json(weather_data, weather_data_filename)
+        updated_at = weather_data.get("properties", {}).get("meta", {}).get("updated_at")
+        freshness.record("weather", observed=utils.parse_utc(updated_at) if updated_at else None,
+                         fetched=fetched, persisted=runtime.now())
+        forecast_archive.add_run(weather_data)
+        return True
     except requests.exceptions.HTTPError as e:
         weatherLogger.warning("get_weather_data() HTTPError")
         weatherLogger.warning("%d %s", e.response.status_code, e.response.text)
     except requests.exceptions.RequestException:
         weatherLogger.error("get_weather_data() RequestException:", exc_info=1)
+    return False
+
+def update():
+    """One polling cycle. Returns False when the forecast could not be fetched."""
+    weatherLogger.info("Fetching new weather data.")
+    return get_weather_data()
 
 def startWeatherService():
     """Starts periodic weather data retrieval."""
-    while True:
-        weatherLogger.info("Fetching new weather data.")
-        get_weather_data()
-        time.sleep(60*60)  # Sleep for 60 min
+    service = scheduler.Scheduler()
+    service.add_job("weather", update, interval=UPDATE_INTERVAL_SECONDS)
+    service.run_forever()
 
 if __name__ == '__main__':
     startWeatherService()